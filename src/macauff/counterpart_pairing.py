@@ -33,64 +33,83 @@ def source_pairing(cm):
     print(f"{t} Rank {cm.rank}, chunk {cm.chunk_id}: Pairing sources...")
     sys.stdout.flush()
 
-    len_a, len_b = np.sum(cm.agrplen), np.sum(cm.bgrplen)
+    amagref, bmagref = cm.a_magref, cm.b_magref
+    agrplen, bgrplen = cm.agrplen, cm.bgrplen
 
-    a_astro = cm.a_astro
-    a_photo = cm.a_photo
-    amagref = cm.a_magref
-
-    b_astro = cm.b_astro
-    b_photo = cm.b_photo
-    bmagref = cm.b_magref
-
-    big_len_a = len(a_astro)
-    big_len_b = len(b_astro)
+    big_len_a = len(cm.a_astro)
+    big_len_b = len(cm.b_astro)
     # large_len is the "safe" initialisation value for arrays, such that no index
     # can ever reach this value.
     large_len = max(big_len_a, big_len_b)
 
-    afourier_grids = cm.a_perturb_auf_outputs['fourier_grid']
-    afrac_grids = cm.a_perturb_auf_outputs['frac_grid']
-    aflux_grids = cm.a_perturb_auf_outputs['flux_grid']
-    bfourier_grids = cm.b_perturb_auf_outputs['fourier_grid']
-    bfrac_grids = cm.b_perturb_auf_outputs['frac_grid']
-    bflux_grids = cm.b_perturb_auf_outputs['flux_grid']
+    afourier_grids, afrac_grids, aflux_grids = (
+        cm.a_perturb_auf_outputs[key] for key in ['fourier_grid', 'frac_grid', 'flux_grid'])
+    bfourier_grids, bfrac_grids, bflux_grids = (
+        cm.b_perturb_auf_outputs[key] for key in ['fourier_grid', 'frac_grid', 'flux_grid'])
 
     # crpts_max_len is the maximum number of counterparts at 100% match rate.
-    cprt_max_len = np.sum(np.minimum(cm.agrplen, cm.bgrplen))
+    cprt_max_len = np.sum(np.minimum(agrplen, bgrplen))
 
     (acountinds, bcountinds, afieldinds, bfieldinds, acontamprob, bcontamprob, etaarray,
      xiarray, acontamflux, bcontamflux, probcarray, crptseps, probfaarray, afieldfluxs,
      afieldseps, afieldetas, afieldxis, probfbarray, bfieldfluxs, bfieldseps, bfieldetas,
      bfieldxis) = cpf.find_island_probabilities(
-        a_astro, a_photo, b_astro, b_photo, cm.alist, cm.blist, cm.agrplen, cm.bgrplen,
+        # The Fortran routine takes column-major arrays; convert the (C-ordered,
+        # typically memory-mapped) catalogues only for the call itself, so the
+        # copies are released as soon as it returns.
+        np.asfortranarray(cm.a_astro), np.asfortranarray(cm.a_photo), np.asfortranarray(cm.b_astro),
+        np.asfortranarray(cm.b_photo), cm.alist, cm.blist, agrplen, bgrplen,
         cm.c_array, cm.fa_array, cm.fb_array, cm.c_priors, cm.fa_priors, cm.fb_priors, amagref, bmagref,
         cm.a_modelrefinds, cm.b_modelrefinds, cm.abinsarray, cm.abinlengths, cm.bbinsarray, cm.bbinlengths,
         afrac_grids, aflux_grids, bfrac_grids, bflux_grids, afourier_grids, bfourier_grids,
         cm.a_sky_inds, cm.b_sky_inds, cm.rho, cm.drho, len(cm.delta_mag_cuts), large_len, cprt_max_len)
 
-    afieldfilter = np.zeros(dtype=bool, shape=(len_a,))
-    bfieldfilter = np.zeros(dtype=bool, shape=(len_b,))
-
-    # *contamprob is (smalllen, nfracs) in shape and our check for correctness needs to check
-    # all nfrac values, requiring an all check.
-    countfilter = (
-        (acountinds < large_len+1) & (bcountinds < large_len+1) &
-        np.all(acontamprob >= 0, axis=0) & np.all(bcontamprob >= 0, axis=0) &
-        (acontamflux >= 0) & (bcontamflux >= 0) & (probcarray >= 0) & (etaarray >= -30) &
-        (xiarray >= -30))
-
-    afieldfilter = (afieldinds < large_len+1) & (probfaarray >= 0)
-
-    bfieldfilter = (bfieldinds < large_len+1) & (probfbarray >= 0)
-
-    countsum = int(np.sum(countfilter))
-    afieldsum = int(np.sum(afieldfilter))
-    bfieldsum = int(np.sum(bfieldfilter))
+    # Any index that was never updated from its large_len+1 initialisation is invalid.
+    large_len_p1 = large_len + 1
+
+    # Each criterion is folded into a single mask in-place, with the element-wise
+    # comparisons written to one re-used scratch buffer, rather than allocating a
+    # new array at every step.
+    countfilter = np.less(acountinds, large_len_p1)
+    buf = np.empty_like(countfilter)
+    countfilter &= np.less(bcountinds, large_len_p1, out=buf)
+    # *contamprob is (nfracs, smalllen) in shape and our check for correctness needs to check
+    # all nfrac values. Rather than materialising the full 2-D comparison for an all check,
+    # fold in one fraction at a time, stopping early if every counterpart is already rejected.
+    for contamprob in (acontamprob, bcontamprob):
+        for k in range(contamprob.shape[0]):
+            if not countfilter.any():
+                break
+            countfilter &= np.greater_equal(contamprob[k], 0, out=buf)
+    countfilter &= np.greater_equal(acontamflux, 0, out=buf)
+    countfilter &= np.greater_equal(bcontamflux, 0, out=buf)
+    countfilter &= np.greater_equal(probcarray, 0, out=buf)
+    countfilter &= np.greater_equal(etaarray, -30, out=buf)
+    countfilter &= np.greater_equal(xiarray, -30, out=buf)
+    del buf
+
+    afieldfilter = np.less(afieldinds, large_len_p1)
+    afieldfilter &= probfaarray >= 0
+
+    bfieldfilter = np.less(bfieldinds, large_len_p1)
+    bfieldfilter &= probfbarray >= 0
+
+    # Convert the masks to indices once, rather than having every one of the
+    # boolean-indexed arrays below re-scan its mask.
+    countidx = np.flatnonzero(countfilter)
+    afieldidx = np.flatnonzero(afieldfilter)
+    bfieldidx = np.flatnonzero(bfieldfilter)
+    # The masks are not needed once converted; release them before the
+    # filtered output arrays are allocated to keep peak memory down.
+    del countfilter, afieldfilter, bfieldfilter
+
+    countsum = countidx.size
+    afieldsum = afieldidx.size
+    bfieldsum = bfieldidx.size
 
     # Reduce size of output files, removing anything that doesn't meet the
     # criteria above from all saved numpy arrays.
-    for file_name, variable, filter_variable in zip(
+    for file_name, variable, filter_idx in zip(
         ['ac', 'bc', 'pacontam', 'pbcontam', 'acontamflux', 'bcontamflux', 'af', 'bf', 'pc', 'eta',
          'xi', 'pfa', 'pfb', 'afieldflux', 'bfieldflux', 'crptseps', 'afieldseps', 'afieldeta',
          'afieldxi', 'bfieldseps', 'bfieldeta', 'bfieldxi'],
@@ -98,31 +117,24 @@ def source_pairing(cm):
          bfieldinds, probcarray, etaarray, xiarray, probfaarray, probfbarray, afieldfluxs,
          bfieldfluxs, crptseps, afieldseps, afieldetas, afieldxis, bfieldseps, bfieldetas,
          bfieldxis],
-        [countfilter, countfilter, countfilter, countfilter, countfilter, countfilter,
-         afieldfilter, bfieldfilter, countfilter, countfilter, countfilter, afieldfilter,
-         bfieldfilter, afieldfilter, bfieldfilter, countfilter, afieldfilter, afieldfilter,
-         afieldfilter, bfieldfilter, bfieldfilter, bfieldfilter]):
-
-        if file_name in ('pacontam', 'pbcontam'):
-            temp_variable = variable[:, filter_variable]
-        else:
-            temp_variable = variable[filter_variable]
-        setattr(cm, file_name, temp_variable)
-
-    tot = countsum + afieldsum + cm.lenrejecta
-    if tot < big_len_a:
-        warnings.warn(f"{big_len_a - tot} catalogue a source{'s' if big_len_a - tot > 1 else ''} "
-                      "not in either counterpart, field, or rejected source lists")
-    if tot > big_len_a:
-        warnings.warn(f"{tot - big_len_a} additional catalogue a "
-                      f"{'indices' if tot - big_len_a > 1 else 'index'} recorded, check results "
-                      "for duplications carefully")
-    tot = countsum + bfieldsum + cm.lenrejectb
-    if tot < big_len_b:
-        warnings.warn(f"{big_len_b - tot} catalogue b source{'s' if big_len_b - tot > 1 else ''} "
-                      "not in either counterpart, field, or rejected source lists.")
-    if tot > big_len_b:
-        warnings.warn(f"{tot - big_len_b} additional catalogue b "
-                      f"{'indices' if tot - big_len_b > 1 else 'index'} recorded, check results "
-                      "for duplications carefully")
+        [countidx, countidx, countidx, countidx, countidx, countidx, afieldidx, bfieldidx,
+         countidx, countidx, countidx, afieldidx, bfieldidx, afieldidx, bfieldidx, countidx,
+         afieldidx, afieldidx, afieldidx, bfieldidx, bfieldidx, bfieldidx]):
+
+        # Sources are always along the final axis, including for the
+        # (nfracs, N)-shaped pacontam and pbcontam.
+        setattr(cm, file_name, np.take(variable, filter_idx, axis=-1))
+
+    # Check that every source is accounted for exactly once; the messages are
+    # only built when there is a mismatch to report.
+    for catname, tot, big_len in zip(['a', 'b'], [countsum + afieldsum + cm.lenrejecta,
+                                                  countsum + bfieldsum + cm.lenrejectb],
+                                     [big_len_a, big_len_b]):
+        if tot < big_len:
+            warnings.warn(f"{big_len - tot} catalogue {catname} source{'s' if big_len - tot > 1 else ''} "
+                          "not in either counterpart, field, or rejected source lists")
+        elif tot > big_len:
+            warnings.warn(f"{tot - big_len} additional catalogue {catname} "
+                          f"{'indices' if tot - big_len > 1 else 'index'} recorded, check results "
+                          "for duplications carefully")
     sys.stdout.flush()
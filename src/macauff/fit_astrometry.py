@@ -260,36 +260,9 @@ class AstrometricCorrections:  # pylint: disable=too-many-instance-attributes
             Flag for whether the output correction arrays ``m`` and ``n`` should
             be saved to disk (``False``) or returned by the function (``True``).
         """
-        if single_sided_auf is not True:
-            raise ValueError("single_sided_auf must be True.")
-        if ax_dimension not in (1, 2):
-            raise ValueError("ax_dimension must either be '1' or '2'.")
-        if npy_or_csv not in ("npy", "csv"):
-            raise ValueError("npy_or_csv must either be 'npy' or 'csv'.")
-        if coord_or_chunk not in ("coord", "chunk"):
-            raise ValueError("coord_or_chunk must either be 'coord' or 'chunk'.")
-        if coord_or_chunk == "chunk" and chunks is None:
-            raise ValueError("chunks must be provided if coord_or_chunk is 'chunk'.")
-        if coord_or_chunk == "chunk" and ax_dimension == 1:
-            raise ValueError("ax_dimension must be 2, and ax1-ax2 pairings provided for each chunk "
-                             "in chunks if coord_or_chunk is 'chunk'.")
-        if coord_or_chunk == "chunk" and (len(ax1_mids) != len(chunks) or
-                                          len(ax2_mids) != len(chunks)):
-            raise ValueError("ax1_mids, ax2_mids, and chunks must all be the same length if "
-                             "coord_or_chunk is 'chunk'.")
-        if coord_system not in ("equatorial", "galactic"):
-            raise ValueError("coord_system must either be 'equatorial' or 'galactic'.")
-        if (pregenerate_cutouts is not None and pregenerate_cutouts is not True and
-                pregenerate_cutouts is not False):
-            raise ValueError("pregenerate_cutouts should either be 'None', 'True' or 'False'.")
-        if pregenerate_cutouts is False and cutout_area is None:
-            raise ValueError("cutout_area must be given if pregenerate_cutouts is 'False'.")
-        if pregenerate_cutouts is False and cutout_height is None:
-            raise ValueError("cutout_height must be given if pregenerate_cutouts is 'False'.")
-        if use_photometric_uncertainties is not True and use_photometric_uncertainties is not False:
-            raise ValueError("use_photometric_uncertainties must either be True or False.")
-        if return_nm is not True and return_nm is not False:
-            raise ValueError("return_nm must either be True or False.")
+        self._validate_inputs(
+            ax1_mids, ax2_mids, ax_dimension, npy_or_csv, coord_or_chunk, coord_system, pregenerate_cutouts,
+            cutout_area, cutout_height, use_photometric_uncertainties, single_sided_auf, chunks, return_nm)
         self.return_nm = return_nm
         self.psf_fwhm = psf_fwhm
         self.numtrials = numtrials
@@ -388,10 +361,51 @@ class AstrometricCorrections:  # pylint: disable=too-many-instance-attributes
         self.n_filt_rows = np.ceil(len(self.mag_indices) / self.n_filt_cols).astype(int)
 
         for folder in [self.save_folder, f'{self.save_folder}/npy', f'{self.save_folder}/pdf']:
-            if not (return_nm and 'npy' in folder):
+            if not (return_nm and folder == f'{self.save_folder}/npy'):
                 if not os.path.exists(folder):
                     os.makedirs(folder)
 
+    @staticmethod
+    # pylint: disable-next=too-many-arguments,too-many-branches
+    def _validate_inputs(ax1_mids, ax2_mids, ax_dimension, npy_or_csv, coord_or_chunk, coord_system,
+                         pregenerate_cutouts, cutout_area, cutout_height, use_photometric_uncertainties,
+                         single_sided_auf, chunks, return_nm):
+        """
+        Verify the option-style inputs to ``AstrometricCorrections``, raising
+        a ``ValueError`` for the first invalid combination found. All
+        parameters are as described in ``__init__``.
+        """
+        if single_sided_auf is not True:
+            raise ValueError("single_sided_auf must be True.")
+        if ax_dimension not in (1, 2):
+            raise ValueError("ax_dimension must either be '1' or '2'.")
+        if npy_or_csv not in ("npy", "csv"):
+            raise ValueError("npy_or_csv must either be 'npy' or 'csv'.")
+        if coord_or_chunk not in ("coord", "chunk"):
+            raise ValueError("coord_or_chunk must either be 'coord' or 'chunk'.")
+        if coord_or_chunk == "chunk" and chunks is None:
+            raise ValueError("chunks must be provided if coord_or_chunk is 'chunk'.")
+        if coord_or_chunk == "chunk" and ax_dimension == 1:
+            raise ValueError("ax_dimension must be 2, and ax1-ax2 pairings provided for each chunk "
+                             "in chunks if coord_or_chunk is 'chunk'.")
+        if coord_or_chunk == "chunk" and (len(ax1_mids) != len(chunks) or
+                                          len(ax2_mids) != len(chunks)):
+            raise ValueError("ax1_mids, ax2_mids, and chunks must all be the same length if "
+                             "coord_or_chunk is 'chunk'.")
+        if coord_system not in ("equatorial", "galactic"):
+            raise ValueError("coord_system must either be 'equatorial' or 'galactic'.")
+        if (pregenerate_cutouts is not None and pregenerate_cutouts is not True and
+                pregenerate_cutouts is not False):
+            raise ValueError("pregenerate_cutouts should either be 'None', 'True' or 'False'.")
+        if pregenerate_cutouts is False and cutout_area is None:
+            raise ValueError("cutout_area must be given if pregenerate_cutouts is 'False'.")
+        if pregenerate_cutouts is False and cutout_height is None:
+            raise ValueError("cutout_height must be given if pregenerate_cutouts is 'False'.")
+        if use_photometric_uncertainties is not True and use_photometric_uncertainties is not False:
+            raise ValueError("use_photometric_uncertainties must either be True or False.")
+        if return_nm is not True and return_nm is not False:
+            raise ValueError("return_nm must either be True or False.")
+
     # pylint: disable-next=too-many-statements,too-many-branches
     def __call__(self, a_cat=None, b_cat=None, a_cat_name=None, b_cat_name=None, a_cat_func=None,
                  b_cat_func=None, tri_download=True, overwrite_all_sightlines=False, make_plots=False,
@@ -1018,8 +1032,8 @@ class AstrometricCorrections:  # pylint: disable=too-many-instance-attributes
             download_trilegal_simulation(self.trifolder, self.trifilterset, ax1_mid, ax2_mid,
                                          self.magnum, self.coord_system, self.maglim_f, min_area,
                                          av=1, sigma_av=0, total_objs=self.tri_num_faint)
-            os.system(f'mv {self.trifolder}/trilegal_auf_simulation.dat '
-                      f'{self.trifolder}/{self.triname.format(ax1_mid, ax2_mid)}_faint.dat')
+            os.replace(f'{self.trifolder}/trilegal_auf_simulation.dat',
+                       f'{self.trifolder}/{self.triname.format(ax1_mid, ax2_mid)}_faint.dat')
 
         ax1s = np.linspace(ax1_min, ax1_max, 7)
         ax2s = np.linspace(ax2_min, ax2_max, 7)
@@ -1195,8 +1209,8 @@ class AstrometricCorrections:  # pylint: disable=too-many-instance-attributes
             self.moden*np.ones_like(self.mag_array), self.mag_array, b_ratio, snr, self.tri_mags,
             self.log10y, self.dtri_mags, self.psf_radius, self.n_norm)
 
-        seed = np.random.default_rng().choice(100000, size=(paf.get_random_seed_size(),
-                                                            len(self.mag_array)))
+        seed = np.random.default_rng().integers(100000, size=(paf.get_random_seed_size(),
+                                                              len(self.mag_array)))
         _, _, four_off_fw, _, _ = \
             paf.perturb_aufs(
                 self.moden*np.ones_like(self.mag_array), self.mag_array, self.r[:-1]+self.dr/2,
@@ -1204,8 +1218,8 @@ class AstrometricCorrections:  # pylint: disable=too-many-instance-attributes
                 self.log10y, self.n_norm, (dm_max/self.dm).astype(int), self.dmcut, self.psf_radius,
                 self.psfsig, self.numtrials, seed, self.dd_params, self.l_cut, 'fw')
 
-        seed = np.random.default_rng().choice(100000, size=(paf.get_random_seed_size(),
-                                                            len(self.mag_array)))
+        seed = np.random.default_rng().integers(100000, size=(paf.get_random_seed_size(),
+                                                              len(self.mag_array)))
         _, _, four_off_ps, _, _ = \
             paf.perturb_aufs(
                 self.moden*np.ones_like(self.mag_array), self.mag_array, self.r[:-1]+self.dr/2,
@@ -19,18 +19,22 @@ Provides the code to query the online TRILEGAL API and download the results.
 '''
 
 
+import functools
 import os
 import re
-import subprocess as sp
 import time
 
 import dustmaps.sfd
 import numpy as np
+import requests
 from astropy.coordinates import SkyCoord
 from astropy.units import UnitsError
 
 __all__ = []
 
+# The process ID and requests.Session for talking to the TRILEGAL webserver.
+_SESSION = None
+
 
 def get_trilegal(filename, ra, dec, folder='.', galactic=False,
                  filterset='kepler_2mass', area=1, magnum=1, maglim=27, binaries=False,
@@ -85,9 +89,6 @@ def get_trilegal(filename, ra, dec, folder='.', galactic=False,
 
     if os.path.isabs(filename):
         folder = ''
-        outfolder = os.path.dirname(filename)
-    else:
-        outfolder = folder
 
     if not re.search(r'\.dat$', filename):
         outfile = f'{folder}/{filename}.dat'
@@ -97,13 +98,13 @@ def get_trilegal(filename, ra, dec, folder='.', galactic=False,
         av = get_av_infinity(l, b, frame='galactic')[0]
 
     result = trilegal_webcall(trilegal_version, l, b, area, binaries, av, sigma_av, filterset,
-                              magnum, maglim, outfile, outfolder)
+                              magnum, maglim, outfile)
 
     return av, result
 
 
 def trilegal_webcall(trilegal_version, l, b, area, binaries, av, sigma_av, filterset, magnum,
-                     maglim, outfile, outfolder):
+                     maglim, outfile):
     """
     Calls TRILEGAL webserver and downloads results file.
 
@@ -131,8 +132,6 @@ def trilegal_webcall(trilegal_version, l, b, area, binaries, av, sigma_av, filte
         Limiting magnitude down to which to simulate sources.
     outfile : string
         Output filename.
-    outfolder : string
-        Output filename's containing folder.
 
     Returns
     -------
@@ -160,66 +159,84 @@ def trilegal_webcall(trilegal_version, l, b, area, binaries, av, sigma_av, filte
                   'object_av=1.504&object_avkind=1&object_cutoffmass=0.8&'
                   'object_file=tab_sfr%2Ffile_sfr_m4.dat&object_a=1&object_b=0&'
                   'output_kind=1')
-    cmd = (f"wget -o {outfolder}/lixo -O {outfolder}/tmpfile --post-data='submit_form=Submit&"
-           f"trilegal_version={trilegal_version}&gal_coord=1&gc_l={l}&gc_b={b}&eq_alpha=0&eq_delta=0&"
-           f"field={area}&photsys_file=tab_mag_odfnew%2Ftab_mag_{filterset}.dat&icm_lim={magnum}&"
-           f"mag_lim={maglim}&mag_res=0.1&binary_kind={binaries}&{mainparams}' "
-           f"{webserver}/cgi-bin/trilegal_{trilegal_version}")
+    data = (f"submit_form=Submit&trilegal_version={trilegal_version}&gal_coord=1&gc_l={l}&gc_b={b}&"
+            f"eq_alpha=0&eq_delta=0&field={area}&photsys_file=tab_mag_odfnew%2Ftab_mag_{filterset}.dat&"
+            f"icm_lim={magnum}&mag_lim={maglim}&mag_res=0.1&binary_kind={binaries}&{mainparams}")
+    # Re-use the connection to the webserver across form submissions and
+    # polling for the results, rather than opening a new one for each request.
+    session = _get_session()
     complete = False
     while not complete:  # pylint: disable=too-many-nested-blocks
-        notconnected = True
         busy = True
         print(f"TRILEGAL is being called with \n l={l} deg, b={b} deg, area={area} sqrdeg\n "
               f"Av={av} with {sigma_av} fractional r.m.s. spread \n in the {filterset} system, complete "
               f"down to mag={maglim} in its {magnum}th filter, use_binaries set to {binaries}.")
-        sp.Popen(cmd, shell=True).wait()  # pylint: disable=consider-using-with
-        if (os.path.exists(f'{outfolder}/tmpfile') and
-                os.path.getsize(f'{outfolder}/tmpfile') > 0):
-            notconnected = False
-        else:
+        try:
+            response = session.post(f'{webserver}/cgi-bin/trilegal_{trilegal_version}', data=data,
+                                    headers={'Content-Type': 'application/x-www-form-urlencoded'},
+                                    timeout=(60, 600))
+            # Error pages from the webserver are treated the same as no
+            # response at all, rather than as it being busy.
+            lines = response.text.splitlines() if response.ok else []
+        except requests.exceptions.RequestException:
+            lines = []
+        if len(lines) == 0:
             print(f"No communication with {webserver}, will retry in 2 min")
             time.sleep(120)
             return "nocomm"
-        if not notconnected:
-            with open(f'{outfolder}/tmpfile', 'r', encoding='utf-8') as f:
-                lines = f.readlines()
-            for line in lines:
-                if 'The results will be available after about 2 minutes' in line:
-                    busy = False
-                    save_line = line
-                    break
-            # pylint: disable-next=consider-using-with
-            sp.Popen(f'rm -f {outfolder}/lixo {outfolder}/tmpfile', shell=True)
-            if not busy:
-                filenameidx = save_line.find('<a href=../tmp/') + 15
-                fileendidx = save_line[filenameidx:].find('.dat')
-                filename = save_line[filenameidx:filenameidx+fileendidx+4]
-                print(f"retrieving data from {filename} ...")
-                while not complete:
-                    time.sleep(40)
-                    modcmd = f'wget -o {outfolder}/lixo -O {outfolder}/{filename} {webserver}/tmp/{filename}'
-                    sp.Popen(modcmd, shell=True).wait()  # pylint: disable=consider-using-with
-                    if os.path.getsize(f'{outfolder}/{filename}') > 0:
-                        with open(f'{outfolder}/{filename}', 'r', encoding='utf-8') as f:
-                            lastline = f.readlines()[-1]
-                        if 'normally' in lastline:
-                            complete = True
-                            print('model downloaded!..')
-                    if not complete:
-                        print('still running...')
-            else:
-                print('Server busy, trying again in 2 minutes')
-                time.sleep(120)
-                # The way the "breakout" return calls work now we don't loop
-                # within trilegal_webcall any more, but the loops and if
-                # statements are left in for backwards compatibility.
-                return "timeout"
-    sp.Popen(f'mv {outfolder}/{filename} {outfile}', shell=True).wait()  # pylint: disable=consider-using-with
+        for line in lines:
+            if 'The results will be available after about 2 minutes' in line:
+                busy = False
+                save_line = line
+                break
+        if not busy:
+            filenameidx = save_line.find('<a href=../tmp/') + 15
+            fileendidx = save_line[filenameidx:].find('.dat')
+            filename = save_line[filenameidx:filenameidx+fileendidx+4]
+            print(f"retrieving data from {filename} ...")
+            while not complete:
+                time.sleep(40)
+                try:
+                    response = session.get(f'{webserver}/tmp/{filename}', timeout=(60, 600))
+                    contents = response.content if response.ok else b''
+                except requests.exceptions.RequestException:
+                    contents = b''
+                if len(contents) > 0 and b'normally' in contents.splitlines()[-1]:
+                    with open(outfile, 'wb') as f:
+                        f.write(contents)
+                    complete = True
+                    print('model downloaded!..')
+                if not complete:
+                    print('still running...')
+        else:
+            print('Server busy, trying again in 2 minutes')
+            time.sleep(120)
+            # The way the "breakout" return calls work now we don't loop
+            # within trilegal_webcall any more, but the loops and if
+            # statements are left in for backwards compatibility.
+            return "timeout"
     print(f'results copied to {outfile}')
 
     return "good"
 
 
+def _get_session():
+    """
+    Returns the ``requests`` session used to communicate with the TRILEGAL
+    webserver, creating it on first use in each process, so that processes
+    forked after a session is created do not share its open connections.
+
+    Returns
+    -------
+    session : ``requests.Session``
+        The session to make TRILEGAL requests through.
+    """
+    global _SESSION  # pylint: disable=global-statement
+    if _SESSION is None or _SESSION[0] != os.getpid():
+        _SESSION = (os.getpid(), requests.Session())
+    return _SESSION[1]
+
+
 def get_av_infinity(ra, dec, frame='icrs'):
     """
     Gets the Schlegel, Finkbeiner & Davis 1998 (ApJ, 500, 525) A_V extinction
@@ -245,7 +262,22 @@ def get_av_infinity(ra, dec, frame='icrs'):
     dec = np.atleast_1d(dec)
     coords = SkyCoord(ra, dec, unit='deg', frame=frame).transform_to('galactic')
 
-    sfd_ebv = dustmaps.sfd.SFDQuery()
+    sfd_ebv = _get_sfd_query()
     av = 2.742 * sfd_ebv(coords)
 
     return av
+
+
+@functools.lru_cache(maxsize=None)
+def _get_sfd_query():
+    """
+    Loads the Schlegel, Finkbeiner & Davis 1998 (ApJ, 500, 525) dust maps,
+    keeping them in memory for all subsequent extinction lookups rather than
+    reading them from disk for every call to ``get_av_infinity``.
+
+    Returns
+    -------
+    sfd_ebv : ``dustmaps.sfd.SFDQuery``
+        The query object for the SFD reddening maps.
+    """
+    return dustmaps.sfd.SFDQuery()
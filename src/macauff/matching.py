@@ -8,6 +8,7 @@ This module provides the high-level framework for performing catalogue-catalogue
 import datetime
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
 from time import sleep
 
@@ -337,9 +338,11 @@ class CrossMatch():
             # Shape, mapped to each of astro/photo/magref respectively,
             # should map to 3, number of magnitudes, and 1, where magref is
             # a 1-D array but the other two are 2-D.
-            fn_a = np.load(f'{path}/con_cat_astro.npy')
-            fn_p = np.load(f'{path}/con_cat_photo.npy')
-            fn_m = np.load(f'{path}/magref.npy')
+            # The catalogues are memory-mapped rather than read in full, since
+            # only the sources in each island are ever accessed at once.
+            fn_a = np.load(f'{path}/con_cat_astro.npy', mmap_mode='r')
+            fn_p = np.load(f'{path}/con_cat_photo.npy', mmap_mode='r')
+            fn_m = np.load(f'{path}/magref.npy', mmap_mode='r')
             if len(fn_a.shape) != 2 or len(fn_p.shape) != 2 or len(fn_m.shape) != 1:
                 raise ValueError("Incorrect number of dimensions in consolidated "
                                  f"catalogue {catname} files.")
@@ -535,35 +538,47 @@ class CrossMatch():
         a_in_overlaps = np.load(f'{self.a_cat_folder_path}/in_chunk_overlap.npy')
         b_in_overlaps = np.load(f'{self.b_cat_folder_path}/in_chunk_overlap.npy')
 
+        # Collect all halo-trimmed outputs first, then write the independent
+        # files concurrently; the GIL is released during the disk writes.
+        outputs = {}
         core_matches = ~a_in_overlaps[self.ac] | ~b_in_overlaps[self.bc]
-        np.save(f'{self.joint_folder_path}/ac.npy', self.ac[core_matches])
-        np.save(f'{self.joint_folder_path}/bc.npy', self.bc[core_matches])
-        for fname in ['pc', 'eta', 'xi', 'crptseps', 'acontamflux', 'bcontamflux']:
-            np.save(f'{self.joint_folder_path}/{fname}.npy', getattr(self, fname)[core_matches])
+        for fname in ['ac', 'bc', 'pc', 'eta', 'xi', 'crptseps', 'acontamflux', 'bcontamflux']:
+            outputs[fname] = getattr(self, fname)[core_matches]
         for fname in ['pacontam', 'pbcontam']:
-            np.save(f'{self.joint_folder_path}/{fname}.npy', getattr(self, fname)[:, core_matches])
+            outputs[fname] = getattr(self, fname)[:, core_matches]
 
         a_core_nonmatches = ~a_in_overlaps[self.af]
         b_core_nonmatches = ~b_in_overlaps[self.bf]
-        np.save(f'{self.joint_folder_path}/af.npy', self.af[a_core_nonmatches])
-        np.save(f'{self.joint_folder_path}/bf.npy', self.bf[b_core_nonmatches])
+        outputs['af'] = self.af[a_core_nonmatches]
+        outputs['bf'] = self.bf[b_core_nonmatches]
         for fnametype, cnm in zip(['a', 'b'], [a_core_nonmatches, b_core_nonmatches]):
             for fname_ in ['{}fieldflux', 'pf{}', '{}fieldeta', '{}fieldxi', '{}fieldseps']:
                 fname = fname_.format(fnametype)
-                np.save(f'{self.joint_folder_path}/{fname}.npy', getattr(self, fname)[cnm])
-
-        if self.reject_a is not None:
-            np.save(f'{self.joint_folder_path}/reject_a.npy',
-                    np.append(np.append(self.reject_a, self.ac[~core_matches]), self.af[~a_core_nonmatches]))
-        else:
-            np.save(f'{self.joint_folder_path}/reject_a.npy',
-                    np.append(self.ac[~core_matches], self.af[~a_core_nonmatches]))
-        if self.reject_b is not None:
-            np.save(f'{self.joint_folder_path}/reject_b.npy',
-                    np.append(np.append(self.reject_b, self.bc[~core_matches]), self.bf[~b_core_nonmatches]))
-        else:
-            np.save(f'{self.joint_folder_path}/reject_b.npy',
-                    np.append(self.bc[~core_matches], self.bf[~b_core_nonmatches]))
+                outputs[fname] = getattr(self, fname)[cnm]
+
+        # Build each rejection list with a single concatenation, rather than
+        # re-copying the growing array for every component appended to it.
+        for fname, reject, c_inds, f_inds, core_nonmatches in zip(
+                ['reject_a', 'reject_b'], [self.reject_a, self.reject_b], [self.ac, self.bc],
+                [self.af, self.bf], [a_core_nonmatches, b_core_nonmatches]):
+            reject_parts = [c_inds[~core_matches], f_inds[~core_nonmatches]]
+            if reject is not None:
+                reject_parts.insert(0, reject)
+            outputs[fname] = np.concatenate(reject_parts)
+
+        # Separations are in arcseconds and never need more than single
+        # precision, so halve their on-disk size.
+        for fname in ['crptseps', 'afieldseps', 'bfieldseps']:
+            outputs[fname] = outputs[fname].astype(np.float32)
+
+        # joint_folder_path is checked to exist when the chunk is initialised.
+        save_prefix = os.path.join(self.joint_folder_path, '')
+        with ThreadPoolExecutor(max_workers=min(8, len(outputs))) as executor:
+            futures = [executor.submit(np.save, save_prefix + fname + '.npy', array)
+                       for fname, array in outputs.items()]
+            # Re-raise any exception from the writes here.
+            for future in futures:
+                future.result()
 
         if self.make_output_csv:
             npy_to_csv(
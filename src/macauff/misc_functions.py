@@ -40,24 +40,56 @@ def create_auf_params_grid(perturb_auf_outputs, auf_pointings, filt_names, array
     grid : numpy.ndarray
         The populated grid of ``array_name`` individual 1-D arrays.
     '''
+    return create_auf_params_grids(perturb_auf_outputs, auf_pointings, filt_names, [array_name],
+                                   arraylengths, [len_first_axis])[0]
+
+
+def create_auf_params_grids(perturb_auf_outputs, auf_pointings, filt_names, array_names,
+                            arraylengths, len_first_axes):
+    '''
+    Create several 3-D or 4-D arrays from series of 2-D arrays at once, looking
+    up each pointing-filter combination only once for all arrays.
+
+    Parameters
+    ----------
+    perturb_auf_outputs : dictionary
+        Dictionary of outputs from series of pointing-filter AUF simulations.
+    auf_pointings : numpy.ndarray
+        Two-dimensional array with the sky coordinates of each pointing used
+        in the perturbation AUF component creation.
+    filt_names : list or numpy.ndarray
+        List of ordered filters for the given catalogue.
+    array_names : list of string
+        The names of the individually-saved arrays to turn into 3-D or 4-D
+        arrays.
+    arraylengths : numpy.ndarray
+        Array containing length of the density-magnitude combinations in each
+        sky/filter combination.
+    len_first_axes : list of integer or None
+        Length of the initial axis of each 4-D array, in the same order as
+        ``array_names``. Entries of ``None`` create 3-D arrays instead.
+
+    Returns
+    -------
+    grids : tuple of numpy.ndarray
+        The populated grids of each of ``array_names``' individual 1-D arrays.
+    '''
     longestnm = np.amax(arraylengths)
-    if len_first_axis is None:
-        grid = np.full(fill_value=-1, dtype=float, order='F',
-                       shape=(longestnm, len(filt_names), len(auf_pointings)))
-    else:
-        grid = np.full(fill_value=-1, dtype=float, order='F',
-                       shape=(len_first_axis, longestnm, len(filt_names), len(auf_pointings)))
+    grids = tuple(
+        np.full(fill_value=-1, dtype=float, order='F', shape=(longestnm, len(filt_names), len(auf_pointings)))
+        if len_first_axis is None else
+        np.full(fill_value=-1, dtype=float, order='F',
+                shape=(len_first_axis, longestnm, len(filt_names), len(auf_pointings)))
+        for len_first_axis in len_first_axes)
     for j, auf_pointing in enumerate(auf_pointings):
         ax1, ax2 = auf_pointing
         for i, filt in enumerate(filt_names):
             perturb_auf_combo = f'{ax1}-{ax2}-{filt}'
-            single_array = perturb_auf_outputs[perturb_auf_combo][array_name]
-            if len_first_axis is None:
-                grid[:arraylengths[i, j], i, j] = single_array
-            else:
-                grid[:, :arraylengths[i, j], i, j] = single_array
+            single_perturb_auf_output = perturb_auf_outputs[perturb_auf_combo]
+            for grid, array_name in zip(grids, array_names):
+                grid[..., :arraylengths[i, j], i, j] = single_perturb_auf_output[array_name]
 
-    return grid
+    return grids
 
 
 def load_small_ref_auf_grid(modrefind, perturb_auf_outputs, file_name_prefixes):
@@ -169,9 +201,13 @@ def _load_rectangular_slice(a, lon1, lon2, lat1, lat2, padding):
     '''
     lon_shift = 180 - (lon2 + lon1)/2
 
-    sky_cut = (_lon_cut(a, lon1, padding, 'greater', lon_shift) &
-               _lon_cut(a, lon2, padding, 'lesser', lon_shift) &
-               _lat_cut(a, lat1, padding, 'greater') & _lat_cut(a, lat2, padding, 'lesser'))
+    sky_cut = _lat_cut(a, lat1, padding, 'greater') & _lat_cut(a, lat2, padding, 'lesser')
+    # The longitude criteria, with their sky separation calculations, are the
+    # more expensive to evaluate, so only check them for sources already
+    # within the latitude limits.
+    a_lat_cut = a[sky_cut]
+    sky_cut[sky_cut] = (_lon_cut(a_lat_cut, lon1, padding, 'greater', lon_shift) &
+                        _lon_cut(a_lat_cut, lon2, padding, 'lesser', lon_shift))
 
     return sky_cut
 
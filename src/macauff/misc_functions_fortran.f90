@@ -33,18 +33,25 @@ subroutine find_nearest_point(source_lon, source_lat, point_lon, point_lat, poin
     integer, intent(out) :: point_ind(size(source_lon))
     ! Loop counters
     integer :: i, j
-    ! Great-circle distance
-    real(dp) :: hav_dist, min_hav_dist
+    ! Haversine of the great-circle distance, which increases monotonically with the distance
+    ! itself, so can be compared directly without converting back to an angle.
+    real(dp) :: hav, min_hav
+    ! Cosines of the source and point latitudes, the latter computed once for all sources.
+    real(dp) :: cos_source_lat, cos_point_lat(size(point_lat))
 
-    !$OMP PARALLEL DO DEFAULT(NONE) PRIVATE(i, min_hav_dist, hav_dist) SHARED(source_lon, source_lat, point_lon, &
-    !$OMP& point_lat, point_ind)
+    cos_point_lat = cos(point_lat / 180.0_dp * pi)
+
+    !$OMP PARALLEL DO DEFAULT(NONE) PRIVATE(i, j, hav, min_hav, cos_source_lat) SHARED(source_lon, source_lat, &
+    !$OMP& point_lon, point_lat, cos_point_lat, point_ind)
     do i = 1, size(source_lon)
-        min_hav_dist = 9999.9_dp
+        min_hav = huge(1.0_dp)
+        cos_source_lat = cos(source_lat(i) / 180.0_dp * pi)
         do j = 1, size(point_lon)
-            call haversine(source_lon(i), point_lon(j), source_lat(i), point_lat(j), hav_dist)
-            if (hav_dist < min_hav_dist) then
+            hav = sin((source_lat(i) - point_lat(j)) / 360.0_dp * pi)**2 + &
+                cos_source_lat * cos_point_lat(j) * sin((source_lon(i) - point_lon(j)) / 360.0_dp * pi)**2
+            if (hav < min_hav) then
                 point_ind(i) = j - 1  ! pre-convert one-index fortran to zero-index python indices
-                min_hav_dist = hav_dist
+                min_hav = hav
             end if
         end do
     end do
@@ -76,4 +83,25 @@ subroutine calc_j0(r, r0, j0s)
 
 end subroutine calc_j0
 
+subroutine get_max_threads(n_threads)
+    ! Number of threads available to subsequent OpenMP parallel regions in this process; one if the
+    ! module was built without OpenMP.
+    !$ use omp_lib, only: omp_get_max_threads
+    integer, intent(out) :: n_threads
+
+    n_threads = 1
+    !$ n_threads = omp_get_max_threads()
+
+end subroutine get_max_threads
+
+subroutine set_num_threads(n_threads)
+    ! Limit the number of threads used by subsequent OpenMP parallel regions in this process, for
+    ! all compiled modules sharing its OpenMP runtime; does nothing if built without OpenMP.
+    !$ use omp_lib, only: omp_set_num_threads
+    integer, intent(in) :: n_threads
+
+    !$ call omp_set_num_threads(n_threads)
+
+end subroutine set_num_threads
+
 end module misc_functions_fortran
\ No newline at end of file
@@ -8,21 +8,26 @@ component of the astrometric uncertainty function.
 # pylint: disable=duplicate-code
 
 import datetime
+import functools
+import multiprocessing
 import os
+import shutil
 import signal
 import sys
 import timeit
+import zipfile
 
 import numpy as np
+import pandas as pd
 import requests
-from astropy.coordinates import SkyCoord
+from scipy import spatial
 
 # pylint: disable=import-error,no-name-in-module
 from macauff.galaxy_counts import create_galaxy_counts
 from macauff.get_trilegal_wrapper import get_av_infinity, get_trilegal
 from macauff.misc_functions import (
     _load_rectangular_slice,
-    create_auf_params_grid,
+    create_auf_params_grids,
     find_model_counts_corrections,
     min_max_lon,
 )
@@ -33,8 +38,11 @@ from macauff.perturbation_auf_fortran import perturbation_auf_fortran as paf
 
 __all__ = ['make_perturb_aufs', 'create_single_perturb_auf']
 
+# Parameters shared by every sky position, set once in each worker process of
+# the make_perturb_aufs pool by _init_pointing_pool.
+_POOL_PARAMS = {}
+
 
-# pylint: disable-next=too-many-locals,too-many-arguments,too-many-branches,too-many-statements
 def make_perturb_aufs(cm, which_cat):
     r"""
     cm : Class
@@ -55,52 +63,9 @@ def make_perturb_aufs(cm, which_cat):
     auf_folder = getattr(cm, f'{which_cat}_auf_folder_path')
     auf_points = getattr(cm, f'{which_cat}_auf_region_points')
     filters = getattr(cm, f'{which_cat}_filt_names')
-    if cm.include_perturb_auf:
-        auf_region_frame = getattr(cm, f'{which_cat}_auf_region_frame')
-        density_radius = getattr(cm, f'{which_cat}_dens_dist')
-        tri_download_flag = getattr(cm, f'{which_cat}_download_tri')
-        tri_set_name = getattr(cm, f'{which_cat}_tri_set_name')
-        tri_filt_num = getattr(cm, f'{which_cat}_tri_filt_num')
-        tri_maglim_faint = getattr(cm, f'{which_cat}_tri_maglim_faint')
-        tri_num_faint = getattr(cm, f'{which_cat}_tri_num_faint')
-        fit_gal_flag = getattr(cm, f'{which_cat}_fit_gal_flag')
-        num_trials = cm.num_trials
-        psf_fwhms = getattr(cm, f'{which_cat}_psf_fwhms')
-        tri_filt_names = getattr(cm, f'{which_cat}_tri_filt_names')
-        d_mag = cm.d_mag
-        delta_mag_cuts = cm.delta_mag_cuts
-        run_fw = getattr(cm, f'{which_cat}_run_fw_auf')
-        run_psf = getattr(cm, f'{which_cat}_run_psf_auf')
-        snr_mag_params = getattr(cm, f'{which_cat}_snr_mag_params')
-        al_avs = getattr(cm, f'{which_cat}_gal_al_avs')
-        if run_psf:
-            dd_params = getattr(cm, f'{which_cat}_dd_params')
-            l_cut = getattr(cm, f'{which_cat}_l_cut')
-        else:
-            # Fake arrays to pass only to run_fw that fortran will accept:
-            dd_params = np.zeros((1, 1), float)
-            l_cut = np.zeros((1), float)
-        if fit_gal_flag:
-            cmau_array = cm.gal_cmau_array
-            wavs = getattr(cm, f'{which_cat}_gal_wavs')
-            z_maxs = getattr(cm, f'{which_cat}_gal_zmax')
-            nzs = getattr(cm, f'{which_cat}_gal_nzs')
-            alpha0 = cm.gal_alpha0
-            alpha1 = cm.gal_alpha1
-            alpha_weight = cm.gal_alphaweight
-            ab_offsets = getattr(cm, f'{which_cat}_gal_aboffsets')
-            filter_names = getattr(cm, f'{which_cat}_gal_filternames')
-            saturation_magnitudes = getattr(cm, f'{which_cat}_saturation_magnitudes')
-
-        # Extract either dummy or real TRILEGAL histogram lists.
-        dens_hist_tri = getattr(cm, f'{which_cat}_dens_hist_tri_list')
-        tri_model_mags = getattr(cm, f'{which_cat}_tri_model_mags_list')
-        tri_model_mag_mids = getattr(cm, f'{which_cat}_tri_model_mag_mids_list')
-        tri_model_mags_interval = getattr(cm, f'{which_cat}_tri_model_mags_interval_list')
-        tri_n_bright_sources_star = getattr(cm, f'{which_cat}_tri_n_bright_sources_star_list')
-
     a_tot_astro = getattr(cm, f'{which_cat}_astro')
     if cm.include_perturb_auf:
+        params = _get_perturb_auf_params(cm, which_cat)
         a_tot_photo = getattr(cm, f'{which_cat}_photo')
 
     n_sources = len(a_tot_astro)
@@ -122,186 +87,113 @@ def make_perturb_aufs(cm, which_cat):
     # combination for future loading purposes.
     arraylengths = np.zeros(dtype=int, shape=(len(filters), len(auf_points)), order='f')
 
-    if cm.include_perturb_auf:
-        local_n = np.zeros(dtype=float, shape=(len(a_tot_astro), len(filters)))
+    if auf_folder is not None:
+        for ax1, ax2 in auf_points:
+            os.makedirs(f'{auf_folder}/{ax1}/{ax2}', exist_ok=True)
 
     perturb_auf_outputs = {}
 
-    for i, auf_point in enumerate(auf_points):
-        ax1, ax2 = auf_point
-        if auf_folder is not None:
-            ax_folder = f'{auf_folder}/{ax1}/{ax2}'
-            if not os.path.exists(ax_folder):
-                os.makedirs(ax_folder, exist_ok=True)
-        else:
-            ax_folder = None
-
-        if cm.include_perturb_auf:
-            sky_cut = modelrefinds[2, :] == i
-            med_index_slice = np.arange(0, len(local_n))[sky_cut]
-            a_photo_cut = a_tot_photo[sky_cut]
-            a_astro_cut = a_tot_astro[sky_cut]
-
-            if len(a_astro_cut) > 0:
-                ax1_min, ax1_max = min_max_lon(a_astro_cut[:, 0])
-                ax2_min, ax2_max = np.amin(a_astro_cut[:, 1]), np.amax(a_astro_cut[:, 1])
-
-                dens_mags = np.empty(len(filters), float)
-                for j in range(len(dens_mags)):  # pylint: disable=consider-using-enumerate
-                    # Take the "density" magnitude (i.e., the faint limit down to
-                    # which to integrate counts per square degree per magnitude) from
-                    # the data, with a small allowance for completeness limit turnover.
-                    hist, bins = np.histogram(a_photo_cut[~np.isnan(a_photo_cut)], bins='auto')
-                    # TODO: relax half-mag cut, make input parameter  pylint: disable=fixme
-                    dens_mags[j] = (bins[:-1]+np.diff(bins)/2)[np.argmax(hist)] - 0.5
-
-        # If there are no sources in this entire section of sky, we don't need
-        # to bother downloading any TRILEGAL simulations since we'll auto-fill
-        # dummy data (and never use it) in the filter loop.
-        if auf_folder is not None and cm.include_perturb_auf and len(a_astro_cut) > 0 and (
-                tri_download_flag or not os.path.isfile(f'{ax_folder}/trilegal_auf_simulation_faint.dat')):
-            # Currently assume that the area of each small patch is a rectangle
-            # on the sky, implicitly assuming that the large region is also a
-            # rectangle, after any spherical projection cos(delta) effects.
-            rect_area = (ax1_max - ax1_min) * (
-                np.sin(np.radians(ax2_max)) - np.sin(np.radians(ax2_min))) * 180/np.pi
-
-            data_bright_dens = np.array([np.sum(~np.isnan(a_photo_cut[:, q]) &
-                                         (a_photo_cut[:, q] <= dens_mags[q])) / rect_area
-                                        for q in range(len(dens_mags))])
-            # TODO: un-hardcode min_bright_tri_number  pylint: disable=fixme
-            min_bright_tri_number = 1000
-            min_area = max(min_bright_tri_number / data_bright_dens)
-            # Hard-coding the AV=1 trick to allow for using av_grid later.
-            download_trilegal_simulation(ax_folder, tri_set_name, ax1, ax2, tri_filt_num,
-                                         auf_region_frame, tri_maglim_faint, min_area,
-                                         av=1, sigma_av=0, total_objs=tri_num_faint,
-                                         rank=cm.rank, chunk_id=cm.chunk_id)
-            os.system(f'mv {ax_folder}/trilegal_auf_simulation.dat '
-                      f'{ax_folder}/trilegal_auf_simulation_faint.dat')
-        for j, filt in enumerate(filters):
-            perturb_auf_combo = f'{ax1}-{ax2}-{filt}'
+    if cm.include_perturb_auf:
+        local_n = np.zeros(dtype=float, shape=(len(a_tot_astro), len(filters)))
+        # Compute the missing-magnitude mask for the full catalogue once, rather
+        # than re-scanning each sky slice for every filter.
+        a_tot_photo_nan = np.isnan(a_tot_photo)
+
+        # Derive each sky position's extent and density magnitudes, and fetch
+        # any TRILEGAL simulations it needs, one sky position at a time in this
+        # process. download_trilegal_simulation times out through SIGALRM,
+        # which only the main thread may use, and the TRILEGAL server queues
+        # requests per client, so concurrent downloads would gain nothing.
+        pointing_inds, pointing_properties = [], []
+        for i, (ax1, ax2) in enumerate(auf_points):
+            sky_inds = np.flatnonzero(modelrefinds[2, :] == i)
+            pointing_inds.append(sky_inds)
+            if len(sky_inds) == 0:
+                # If there are no sources in this entire section of sky, we don't
+                # need to bother downloading any TRILEGAL simulations since we'll
+                # auto-fill dummy data (and never use it) in the filter loop.
+                pointing_properties.append(None)
+                continue
+            a_photo_cut = a_tot_photo[sky_inds]
+            sky_limits, rect_area, dens_mags = _get_pointing_properties(
+                a_tot_astro[sky_inds], a_photo_cut, a_tot_photo_nan[sky_inds])
+            pointing_properties.append((sky_limits, rect_area, dens_mags))
+            ax_folder = f'{auf_folder}/{ax1}/{ax2}' if auf_folder is not None else None
+            if ax_folder is not None and (
+                    params['tri_download_flag'] or
+                    not os.path.isfile(f'{ax_folder}/trilegal_auf_simulation_faint.dat')):
+                # NaN magnitudes always compare False, so need no separate masking.
+                data_bright_dens = np.count_nonzero(a_photo_cut <= dens_mags, axis=0) / rect_area
+                # TODO: un-hardcode min_bright_tri_number  pylint: disable=fixme
+                min_bright_tri_number = 1000
+                min_area = max(min_bright_tri_number / data_bright_dens)
+                # Hard-coding the AV=1 trick to allow for using av_grid later.
+                download_trilegal_simulation(ax_folder, params['tri_set_name'], ax1, ax2,
+                                             params['tri_filt_num'], params['auf_region_frame'],
+                                             params['tri_maglim_faint'], min_area, av=1, sigma_av=0,
+                                             total_objs=params['tri_num_faint'], rank=params['rank'],
+                                             chunk_id=params['chunk_id'])
+                os.replace(f'{ax_folder}/trilegal_auf_simulation.dat',
+                           f'{ax_folder}/trilegal_auf_simulation_faint.dat')
+
+        def pointing_inputs():
+            for i, (ax1, ax2) in enumerate(auf_points):
+                ax_folder = f'{auf_folder}/{ax1}/{ax2}' if auf_folder is not None else None
+                sky_inds = pointing_inds[i]
+                if pointing_properties[i] is not None:
+                    # Only pass each sky position the part of the full catalogue
+                    # that could fall inside the local density circles of its
+                    # sources; calculate_local_density re-applies its own,
+                    # tighter, cut.
+                    ax1_min, ax1_max, ax2_min, ax2_max = pointing_properties[i][0]
+                    overlap_cut = _load_rectangular_slice(a_tot_astro, ax1_min, ax1_max, ax2_min, ax2_max,
+                                                          2 * params['density_radius'])
+                else:
+                    overlap_cut = np.zeros(n_sources, bool)
+                yield (i, auf_points[i], ax_folder, a_tot_astro[sky_inds], a_tot_photo[sky_inds],
+                       a_tot_photo_nan[sky_inds], pointing_properties[i], a_tot_astro[overlap_cut],
+                       a_tot_photo[overlap_cut])
 
-            if cm.include_perturb_auf:
-                good_mag_slice = ~np.isnan(a_photo_cut[:, j])
-                a_photo = a_photo_cut[good_mag_slice, j]
-                if len(a_photo) == 0:
-                    arraylengths[j, i] = 0
-                    # If no sources in this AUF-filter combination, we need to
-                    # fake some dummy variables for use in the 3/4-D grids below.
-                    # See below, in include_perturb_auf is False, for meanings.
-                    num_n_mag = 1
-                    frac = np.zeros((1, num_n_mag), float, order='F')
-                    flux = np.zeros(num_n_mag, float, order='F')
-                    offset = np.zeros((len(cm.r)-1, num_n_mag), float, order='F')
-                    offset[0, :] = 1 / (2 * np.pi * (cm.r[0] + cm.dr[0]/2) * cm.dr[0])
-                    cumulative = np.ones((len(cm.r)-1, num_n_mag), float, order='F')
-                    fourieroffset = np.ones((len(cm.rho)-1, num_n_mag), float, order='F')
-                    narray = np.array([[1]], float)
-                    magarray = np.array([[1]], float)
-                    # Make a second dictionary with the single pointing-filter
-                    # combination in it.
-                    single_perturb_auf_output = {}
-                    for name, entry in zip(
-                            ['frac', 'flux', 'offset', 'cumulative', 'fourier', 'Narray',
-                             'magarray'], [frac, flux, offset, cumulative, fourieroffset, narray,
-                                           magarray]):
-                        single_perturb_auf_output[name] = entry
-                    perturb_auf_outputs[perturb_auf_combo] = single_perturb_auf_output
-                    continue
-                localn = calculate_local_density(
-                    a_astro_cut[good_mag_slice], a_tot_astro, a_tot_photo[:, j], density_radius, dens_mags[j])
+        def gather_pointing_outputs(results):
+            for i, localn, single_arraylengths, single_perturb_auf_outputs in results:
                 # Because we always calculate the density from the full
                 # catalogue, using just the astrometry, we should be able
                 # to just over-write this N times if there happen to be N
                 # good detections of a source.
-                index_slice = med_index_slice[good_mag_slice]
-                for ii, ind_slice in enumerate(index_slice):
-                    local_n[ind_slice, j] = localn[ii]
-                if fit_gal_flag:
-                    rect_area = (ax1_max - ax1_min) * (
-                        np.sin(np.radians(ax2_max)) - np.sin(np.radians(ax2_min))) * 180/np.pi
-                ax1_list = np.linspace(ax1_min, ax1_max, 7)
-                ax2_list = np.linspace(ax2_min, ax2_max, 7)
-                if fit_gal_flag:
-                    single_perturb_auf_output = create_single_perturb_auf(
-                        auf_points[i], cm.r, cm.dr, cm.j0s, num_trials, psf_fwhms[j], dens_mags[j], a_photo,
-                        localn, d_mag, delta_mag_cuts, dd_params, l_cut, run_fw, run_psf, snr_mag_params[j],
-                        al_avs[j], auf_region_frame, ax1_list, ax2_list, fit_gal_flag, rect_area,
-                        saturation_magnitudes[j], cmau_array, wavs[j], z_maxs[j], nzs[j], alpha0, alpha1,
-                        alpha_weight, ab_offsets[j], filter_names[j], tri_folder=ax_folder,
-                        filt_header=tri_filt_names[j], dens_hist_tri=dens_hist_tri[j],
-                        model_mags=tri_model_mags[j], model_mag_mids=tri_model_mag_mids[j],
-                        model_mags_interval=tri_model_mags_interval[j],
-                        n_bright_sources_star=tri_n_bright_sources_star[j])
-                else:
-                    single_perturb_auf_output = create_single_perturb_auf(
-                        auf_points[i], cm.r, cm.dr, cm.j0s, num_trials, psf_fwhms[j], dens_mags[j], a_photo,
-                        localn, d_mag, delta_mag_cuts, dd_params, l_cut, run_fw, run_psf, snr_mag_params[j],
-                        al_avs[j], auf_region_frame, ax1_list, ax2_list, fit_gal_flag, tri_folder=ax_folder,
-                        filt_header=tri_filt_names[j], dens_hist_tri=dens_hist_tri[j],
-                        model_mags=tri_model_mags[j], model_mag_mids=tri_model_mag_mids[j],
-                        model_mags_interval=tri_model_mags_interval[j],
-                        n_bright_sources_star=tri_n_bright_sources_star[j])
-                perturb_auf_outputs[perturb_auf_combo] = single_perturb_auf_output
-            else:
-                # Without the simulations to force local normalising density N or
-                # individual source brightness magnitudes, we can simply combine
-                # all data into a single "bin".
-                num_n_mag = 1
-                # In cases where we do not want to use the perturbation AUF component,
-                # we currently don't have separate functions, but instead set up dummy
-                # functions and variables to pass what mathematically amounts to
-                # "nothing" through the cross-match. Here we would use fortran
-                # subroutines to create the perturbation simulations, so we make
-                # f-ordered dummy parameters.
-                frac = np.zeros((1, num_n_mag), float, order='F')
-                flux = np.zeros(num_n_mag, float, order='F')
-                # Remember that r is bins, so the evaluations at bin middle are one
-                # shorter in length.
-                offset = np.zeros((len(cm.r)-1, num_n_mag), float, order='F')
-                # Fix offsets such that the probability density function looks like
-                # a delta function, such that a two-dimensional circular coordinate
-                # integral would evaluate to one at every point, cf. ``cumulative``.
-                offset[0, :] = 1 / (2 * np.pi * (cm.r[0] + cm.dr[0]/2) * cm.dr[0])
-                # The cumulative integral of a delta function is always unity.
-                cumulative = np.ones((len(cm.r)-1, num_n_mag), float, order='F')
-                # The Hankel transform of a delta function is a flat line; this
-                # then preserves the convolution being multiplication in fourier
-                # space, as F(x) x 1 = F(x), similar to how f(x) * d(0) = f(x).
-                fourieroffset = np.ones((len(cm.rho)-1, num_n_mag), float, order='F')
-                # Both normalising density and magnitude arrays can be proxied
-                # with a dummy parameter, as any minimisation of N-m distance
-                # must pick the single value anyway.
-                narray = np.array([[1]], float)
-                magarray = np.array([[1]], float)
-                single_perturb_auf_output = {}
-                for name, entry in zip(
-                        ['frac', 'flux', 'offset', 'cumulative', 'fourier', 'Narray', 'magarray'],
-                        [frac, flux, offset, cumulative, fourieroffset, narray, magarray]):
-                    single_perturb_auf_output[name] = entry
-                perturb_auf_outputs[perturb_auf_combo] = single_perturb_auf_output
-            arraylengths[j, i] = len(perturb_auf_outputs[perturb_auf_combo]['Narray'])
-
-    if cm.include_perturb_auf:
-        longestnm = np.amax(arraylengths)
-
-        narrays = np.full(dtype=float, shape=(longestnm, len(filters), len(auf_points)),
-                          order='F', fill_value=-1)
-
-        magarrays = np.full(dtype=float, shape=(longestnm, len(filters), len(auf_points)),
-                            order='F', fill_value=-1)
-
-        for i, auf_point in enumerate(auf_points):
-            ax1, ax2 = auf_point
-            for j, filt in enumerate(filters):
-                if arraylengths[j, i] == 0:
-                    continue
-                perturb_auf_combo = f'{ax1}-{ax2}-{filt}'
-                narray = perturb_auf_outputs[perturb_auf_combo]['Narray']
-                magarray = perturb_auf_outputs[perturb_auf_combo]['magarray']
-                narrays[:arraylengths[j, i], j, i] = narray
-                magarrays[:arraylengths[j, i], j, i] = magarray
+                local_n[pointing_inds[i]] = localn
+                arraylengths[:, i] = single_arraylengths
+                ax1, ax2 = auf_points[i]
+                for j, filt in enumerate(filters):
+                    perturb_auf_outputs[f'{ax1}-{ax2}-{filt}'] = single_perturb_auf_outputs[j]
+
+        if cm.n_pool == 1:
+            # With a single process there is nothing to gain from a pool, and
+            # simulating in this process avoids forking at all, e.g. from
+            # within an MPI rank.
+            gather_pointing_outputs(_make_pointing_perturb_aufs(pointing, params)
+                                    for pointing in pointing_inputs())
+        else:
+            # Each sky position is simulated independently, so distribute them
+            # across processes, gathering the results as they complete. The
+            # shared parameters, including the large j0s grid, are handed to
+            # each worker once when it starts rather than with every sky
+            # position, and each worker's OpenMP threads are limited to its
+            # share of those available, so the pool does not oversubscribe the
+            # cores.
+            n_threads = max(1, mff.get_max_threads() // cm.n_pool)
+            with multiprocessing.Pool(cm.n_pool, initializer=_init_pointing_pool,
+                                      initargs=(params, n_threads)) as pool:
+                gather_pointing_outputs(pool.imap_unordered(_make_pooled_pointing_perturb_aufs,
+                                                            pointing_inputs()))
+                pool.close()
+                pool.join()
+    else:
+        for ax1, ax2 in auf_points:
+            for filt in filters:
+                perturb_auf_outputs[f'{ax1}-{ax2}-{filt}'] = _make_dummy_perturb_auf_output(
+                    cm.r, cm.dr, cm.rho)
+        # Our dummy N-m arrays are all one-length arrays.
+        arraylengths[:, :] = 1
 
     # Once the individual AUF simulations are saved, we also need to calculate
     # the indices each source references when slicing into the 4-D cubes
@@ -312,20 +204,15 @@ def make_perturb_aufs(cm, which_cat):
           f'catalogue "{which_cat}"...')
     sys.stdout.flush()
 
-    if cm.include_perturb_auf:
-        a = getattr(cm, f'{which_cat}_photo')
-        localn = local_n
     magref = getattr(cm, f'{which_cat}_magref')
 
     if cm.include_perturb_auf:
-        for i in range(0, len(a)):
-            axind = modelrefinds[2, i]
-            filterind = magref[i]
-            nmind = np.argmin((localn[i, filterind] - narrays[:arraylengths[filterind, axind],
-                                                              filterind, axind])**2 +
-                              (a[i, filterind] - magarrays[:arraylengths[filterind, axind],
-                                                           filterind, axind])**2)
-            modelrefinds[0, i] = nmind
+        # Find each source's closest simulated N-m combination, using its
+        # local density and magnitude in its reference filter.
+        source_inds = np.arange(n_sources)
+        modelrefinds[0, :] = _find_closest_nm_combinations(
+            perturb_auf_outputs, auf_points, filters, arraylengths, local_n[source_inds, magref],
+            a_tot_photo[source_inds, magref], modelrefinds[2, :], magref)
     else:
         # For the case that we do not use the perturbation AUF component,
         # our dummy N-m files are all one-length arrays, so we can
@@ -339,24 +226,354 @@ def make_perturb_aufs(cm, which_cat):
     if not cm.include_perturb_auf:
         n_fracs = 2  # TODO: generalise once delta_mag_cuts is user-inputtable.  pylint: disable=fixme
     else:
-        n_fracs = len(delta_mag_cuts)
+        n_fracs = len(params['delta_mag_cuts'])
     # Create the 4-D grids that house the perturbation AUF fourier-space
-    # representation.
-    perturb_auf_outputs['fourier_grid'] = create_auf_params_grid(
-        perturb_auf_outputs, auf_points, filters, 'fourier', arraylengths, len(cm.rho)-1)
-    # Create the estimated levels of flux contamination and fraction of
-    # contaminated source grids.
-    perturb_auf_outputs['frac_grid'] = create_auf_params_grid(
-        perturb_auf_outputs, auf_points, filters, 'frac', arraylengths, n_fracs)
-    perturb_auf_outputs['flux_grid'] = create_auf_params_grid(
-        perturb_auf_outputs, auf_points, filters, 'flux', arraylengths)
-
-    if cm.include_perturb_auf:
-        del narrays, magarrays
+    # representation, and the estimated levels of flux contamination and
+    # fraction of contaminated source grids, in one pass over the outputs.
+    (perturb_auf_outputs['fourier_grid'], perturb_auf_outputs['frac_grid'],
+     perturb_auf_outputs['flux_grid']) = create_auf_params_grids(
+        perturb_auf_outputs, auf_points, filters, ['fourier', 'frac', 'flux'], arraylengths,
+        [len(cm.rho)-1, n_fracs, None])
 
     return modelrefinds, perturb_auf_outputs
 
 
+def _get_perturb_auf_params(cm, which_cat):
+    '''
+    Collects the parameters needed to simulate the perturbation AUFs of a
+    single sky position, which are shared between all sky positions.
+
+    Parameters
+    ----------
+    cm : Class
+        The cross-match wrapper, containing all of the necessary metadata to
+        perform the cross-match and determine photometric likelihoods.
+    which_cat : string
+        Indicator as to whether these perturbation AUFs are for catalogue "a"
+        or catalogue "b" within the cross-match process.
+
+    Returns
+    -------
+    params : dictionary
+        The single-catalogue parameters for the perturbation AUF simulations.
+    '''
+    params = {'rank': cm.rank, 'chunk_id': cm.chunk_id, 'r': cm.r, 'dr': cm.dr, 'rho': cm.rho,
+              'j0s': cm.j0s, 'num_trials': cm.num_trials, 'd_mag': cm.d_mag,
+              'delta_mag_cuts': cm.delta_mag_cuts}
+    for name, attribute in [
+            ('auf_region_frame', 'auf_region_frame'), ('density_radius', 'dens_dist'),
+            ('tri_download_flag', 'download_tri'), ('tri_set_name', 'tri_set_name'),
+            ('tri_filt_num', 'tri_filt_num'), ('tri_maglim_faint', 'tri_maglim_faint'),
+            ('tri_num_faint', 'tri_num_faint'), ('fit_gal_flag', 'fit_gal_flag'),
+            ('psf_fwhms', 'psf_fwhms'), ('tri_filt_names', 'tri_filt_names'),
+            ('run_fw', 'run_fw_auf'), ('run_psf', 'run_psf_auf'), ('snr_mag_params', 'snr_mag_params'),
+            ('al_avs', 'gal_al_avs'),
+            # Extract either dummy or real TRILEGAL histogram lists.
+            ('dens_hist_tri', 'dens_hist_tri_list'), ('tri_model_mags', 'tri_model_mags_list'),
+            ('tri_model_mag_mids', 'tri_model_mag_mids_list'),
+            ('tri_model_mags_interval', 'tri_model_mags_interval_list'),
+            ('tri_n_bright_sources_star', 'tri_n_bright_sources_star_list')]:
+        params[name] = getattr(cm, f'{which_cat}_{attribute}')
+    if params['run_psf']:
+        params['dd_params'] = getattr(cm, f'{which_cat}_dd_params')
+        params['l_cut'] = getattr(cm, f'{which_cat}_l_cut')
+    else:
+        # Fake arrays to pass only to run_fw that fortran will accept:
+        params['dd_params'] = np.zeros((1, 1), float)
+        params['l_cut'] = np.zeros((1), float)
+    if params['fit_gal_flag']:
+        params['cmau_array'] = cm.gal_cmau_array
+        params['alpha0'] = cm.gal_alpha0
+        params['alpha1'] = cm.gal_alpha1
+        params['alpha_weight'] = cm.gal_alphaweight
+        for name, attribute in [('wavs', 'gal_wavs'), ('z_maxs', 'gal_zmax'), ('nzs', 'gal_nzs'),
+                                ('ab_offsets', 'gal_aboffsets'), ('filter_names', 'gal_filternames'),
+                                ('saturation_magnitudes', 'saturation_magnitudes')]:
+            params[name] = getattr(cm, f'{which_cat}_{attribute}')
+
+    return params
+
+
+def _make_dummy_perturb_auf_output(r, dr, rho):
+    '''
+    Creates the placeholder perturbation AUF outputs of a single sky
+    position-filter combination, for which no simulations are run.
+
+    Parameters
+    ----------
+    r : numpy.ndarray
+        The real-space coordinates for the Hankel transformations.
+    dr : numpy.ndarray
+        The spacings between ``r`` elements.
+    rho : numpy.ndarray
+        The fourier-space coordinates for Hankel transformations.
+
+    Returns
+    -------
+    single_perturb_auf_output : dictionary
+        The dummy perturbation AUF outputs, describing a delta function
+        perturbation component with no contaminant flux.
+    '''
+    # Without the simulations to force local normalising density N or
+    # individual source brightness magnitudes, we can simply combine
+    # all data into a single "bin".
+    num_n_mag = 1
+    # In cases where we do not want to use the perturbation AUF component,
+    # we currently don't have separate functions, but instead set up dummy
+    # functions and variables to pass what mathematically amounts to
+    # "nothing" through the cross-match. Here we would use fortran
+    # subroutines to create the perturbation simulations, so we make
+    # f-ordered dummy parameters.
+    frac = np.zeros((1, num_n_mag), float, order='F')
+    flux = np.zeros(num_n_mag, float, order='F')
+    # Remember that r is bins, so the evaluations at bin middle are one
+    # shorter in length.
+    offset = np.zeros((len(r)-1, num_n_mag), float, order='F')
+    # Fix offsets such that the probability density function looks like
+    # a delta function, such that a two-dimensional circular coordinate
+    # integral would evaluate to one at every point, cf. ``cumulative``.
+    offset[0, :] = 1 / (2 * np.pi * (r[0] + dr[0]/2) * dr[0])
+    # The cumulative integral of a delta function is always unity.
+    cumulative = np.ones((len(r)-1, num_n_mag), float, order='F')
+    # The Hankel transform of a delta function is a flat line; this
+    # then preserves the convolution being multiplication in fourier
+    # space, as F(x) x 1 = F(x), similar to how f(x) * d(0) = f(x).
+    fourieroffset = np.ones((len(rho)-1, num_n_mag), float, order='F')
+    # Both normalising density and magnitude arrays can be proxied
+    # with a dummy parameter, as any minimisation of N-m distance
+    # must pick the single value anyway.
+    narray = np.array([[1]], float)
+    magarray = np.array([[1]], float)
+    single_perturb_auf_output = {}
+    for name, entry in zip(
+            ['frac', 'flux', 'offset', 'cumulative', 'fourier', 'Narray', 'magarray'],
+            [frac, flux, offset, cumulative, fourieroffset, narray, magarray]):
+        single_perturb_auf_output[name] = entry
+
+    return single_perturb_auf_output
+
+
+def _find_closest_nm_combinations(perturb_auf_outputs, auf_points, filters, arraylengths, source_n,
+                                  source_mag, axinds, filterinds):
+    '''
+    Determines the simulated density-magnitude combination closest to each
+    source, for its sky position and filter.
+
+    Parameters
+    ----------
+    perturb_auf_outputs : dictionary
+        The perturbation AUF outputs of each sky position-filter combination.
+    auf_points : numpy.ndarray
+        The sky positions at which perturbation AUFs were simulated.
+    filters : numpy.ndarray
+        The filters in which perturbation AUFs were simulated.
+    arraylengths : numpy.ndarray
+        The number of density-magnitude combinations simulated in each
+        filter-sky position combination.
+    source_n : numpy.ndarray
+        The local normalising density of each source.
+    source_mag : numpy.ndarray
+        The magnitude of each source.
+    axinds : numpy.ndarray
+        The index into ``auf_points`` of each source.
+    filterinds : numpy.ndarray
+        The index into ``filters`` of each source.
+
+    Returns
+    -------
+    numpy.ndarray
+        The index of the closest density-magnitude combination to each source.
+    '''
+    longestnm = np.amax(arraylengths)
+
+    # Fortran ordering keeps each sky position-filter N-m array contiguous
+    # in memory, for the per-source nearest-combination search.
+    narrays = np.full(dtype=float, shape=(longestnm, len(filters), len(auf_points)),
+                      order='F', fill_value=-1)
+
+    magarrays = np.full(dtype=float, shape=(longestnm, len(filters), len(auf_points)),
+                        order='F', fill_value=-1)
+
+    for i, auf_point in enumerate(auf_points):
+        ax1, ax2 = auf_point
+        for j, filt in enumerate(filters):
+            if arraylengths[j, i] == 0:
+                continue
+            perturb_auf_combo = f'{ax1}-{ax2}-{filt}'
+            narray = perturb_auf_outputs[perturb_auf_combo]['Narray']
+            magarray = perturb_auf_outputs[perturb_auf_combo]['magarray']
+            narrays[:arraylengths[j, i], j, i] = narray
+            magarrays[:arraylengths[j, i], j, i] = magarray
+
+    return paf.find_closest_nm_points(source_n, source_mag, axinds, filterinds, narrays, magarrays,
+                                      arraylengths)
+
+
+def _get_pointing_properties(a_astro_cut, a_photo_cut, a_photo_cut_nan):
+    '''
+    Determines the sky extent of the sources assigned to a sky position, and
+    the magnitudes down to which their local densities are calculated.
+
+    Parameters
+    ----------
+    a_astro_cut : numpy.ndarray
+        The astrometry of the sources assigned to the sky position.
+    a_photo_cut : numpy.ndarray
+        The photometry of the sources, in each filter.
+    a_photo_cut_nan : numpy.ndarray
+        Boolean mask of the missing magnitudes in ``a_photo_cut``.
+
+    Returns
+    -------
+    sky_limits : tuple of floats
+        The minimum and maximum longitude and latitude of the sources.
+    rect_area : float
+        The area of the rectangle on the sky bounded by ``sky_limits``, in
+        square degrees.
+    dens_mags : numpy.ndarray
+        The magnitude, in each filter, down to which to count sources towards
+        local normalising densities.
+    '''
+    ax1_min, ax1_max = min_max_lon(a_astro_cut[:, 0])
+    ax2_min, ax2_max = np.amin(a_astro_cut[:, 1]), np.amax(a_astro_cut[:, 1])
+    # Currently assume that the area of each small patch is a rectangle
+    # on the sky, implicitly assuming that the large region is also a
+    # rectangle, after any spherical projection cos(delta) effects.
+    rect_area = (ax1_max - ax1_min) * (
+        np.sin(np.radians(ax2_max)) - np.sin(np.radians(ax2_min))) * 180/np.pi
+
+    dens_mags = np.empty(a_photo_cut.shape[1], float)
+    for j in range(a_photo_cut.shape[1]):
+        # Take the "density" magnitude (i.e., the faint limit down to
+        # which to integrate counts per square degree per magnitude) from
+        # the data, with a small allowance for completeness limit turnover.
+        hist, bins = np.histogram(a_photo_cut[~a_photo_cut_nan[:, j], j], bins='auto')
+        # TODO: relax half-mag cut, make input parameter  pylint: disable=fixme
+        dens_mags[j] = (bins[:-1]+np.diff(bins)/2)[np.argmax(hist)] - 0.5
+
+    return (ax1_min, ax1_max, ax2_min, ax2_max), rect_area, dens_mags
+
+
+def _init_pointing_pool(params, n_threads):
+    '''
+    Initialises a worker process of the ``make_perturb_aufs`` pool, storing
+    the parameters shared by all sky positions and limiting its OpenMP threads.
+
+    Parameters
+    ----------
+    params : dictionary
+        The parameters shared by all sky positions, as given by
+        ``_get_perturb_auf_params``.
+    n_threads : integer
+        The number of OpenMP threads the worker process may use.
+    '''
+    _POOL_PARAMS.update(params)
+    mff.set_num_threads(n_threads)
+
+
+def _make_pooled_pointing_perturb_aufs(pointing):
+    '''
+    Wrapper around ``_make_pointing_perturb_aufs`` for the ``make_perturb_aufs``
+    pool, using the shared parameters stored by ``_init_pointing_pool``.
+
+    Parameters
+    ----------
+    pointing : tuple
+        The inputs of a single sky position; see
+        ``_make_pointing_perturb_aufs``.
+
+    Returns
+    -------
+    tuple
+        The outputs of ``_make_pointing_perturb_aufs``.
+    '''
+    return _make_pointing_perturb_aufs(pointing, _POOL_PARAMS)
+
+
+def _make_pointing_perturb_aufs(pointing, params):
+    '''
+    Creates the perturbation AUFs of a single sky position, across all filters.
+
+    Parameters
+    ----------
+    pointing : tuple
+        The index into and coordinates of the sky position, the folder in which
+        its TRILEGAL simulations are kept, the astrometry, photometry, and
+        missing-magnitude mask of the sources assigned to it, their sky
+        limits, rectangular area and density magnitudes as given by
+        ``_get_pointing_properties`` (or ``None`` if there are no sources),
+        and the astrometry and photometry of all catalogue sources near enough
+        to count towards their local normalising densities.
+    params : dictionary
+        The parameters shared by all sky positions, as given by
+        ``_get_perturb_auf_params``.
+
+    Returns
+    -------
+    i : integer
+        The index of the sky position the perturbation AUFs were created for.
+    local_n : numpy.ndarray
+        The local normalising density of each source assigned to the sky
+        position, in each filter; zero for sources not detected in a filter.
+    arraylengths : numpy.ndarray
+        The number of density-magnitude combinations simulated in each filter.
+    single_perturb_auf_outputs : list of dictionaries
+        The perturbation AUF simulation outputs for each filter.
+    '''
+    (i, auf_point, ax_folder, a_astro_cut, a_photo_cut, a_photo_cut_nan, pointing_properties,
+     a_overlap_astro, a_overlap_photo) = pointing
+    n_filts = a_photo_cut.shape[1]
+    fit_gal_flag = params['fit_gal_flag']
+
+    if pointing_properties is None:
+        # If there are no sources in this entire section of sky, every filter
+        # gets dummy outputs, which will never be used.
+        return (i, np.zeros((0, n_filts), float), np.zeros(n_filts, int),
+                [_make_dummy_perturb_auf_output(params['r'], params['dr'], params['rho'])
+                 for _ in range(n_filts)])
+    (ax1_min, ax1_max, ax2_min, ax2_max), rect_area, dens_mags = pointing_properties
+
+    local_n = np.zeros((len(a_astro_cut), n_filts), float)
+    arraylengths = np.zeros(n_filts, int)
+    single_perturb_auf_outputs = []
+    for j in range(n_filts):
+        good_mag_slice = ~a_photo_cut_nan[:, j]
+        a_photo = a_photo_cut[good_mag_slice, j]
+        if len(a_photo) == 0:
+            # If no sources in this AUF-filter combination, we need to
+            # fake some dummy variables for use in the 3/4-D grids.
+            single_perturb_auf_output = _make_dummy_perturb_auf_output(
+                params['r'], params['dr'], params['rho'])
+            single_perturb_auf_outputs.append(single_perturb_auf_output)
+            continue
+        localn = calculate_local_density(
+            a_astro_cut[good_mag_slice], a_overlap_astro, a_overlap_photo[:, j], params['density_radius'],
+            dens_mags[j])
+        local_n[good_mag_slice, j] = localn
+        ax1_list = np.linspace(ax1_min, ax1_max, 7)
+        ax2_list = np.linspace(ax2_min, ax2_max, 7)
+        single_perturb_auf_args = [
+            auf_point, params['r'], params['dr'], params['j0s'], params['num_trials'], params['psf_fwhms'][j],
+            dens_mags[j], a_photo, localn, params['d_mag'], params['delta_mag_cuts'], params['dd_params'],
+            params['l_cut'], params['run_fw'], params['run_psf'], params['snr_mag_params'][j],
+            params['al_avs'][j], params['auf_region_frame'], ax1_list, ax2_list, fit_gal_flag]
+        if fit_gal_flag:
+            single_perturb_auf_args += [
+                rect_area, params['saturation_magnitudes'][j], params['cmau_array'], params['wavs'][j],
+                params['z_maxs'][j], params['nzs'][j], params['alpha0'], params['alpha1'],
+                params['alpha_weight'], params['ab_offsets'][j], params['filter_names'][j]]
+        single_perturb_auf_output = create_single_perturb_auf(
+            *single_perturb_auf_args, tri_folder=ax_folder, filt_header=params['tri_filt_names'][j],
+            dens_hist_tri=params['dens_hist_tri'][j], model_mags=params['tri_model_mags'][j],
+            model_mag_mids=params['tri_model_mag_mids'][j],
+            model_mags_interval=params['tri_model_mags_interval'][j],
+            n_bright_sources_star=params['tri_n_bright_sources_star'][j])
+        single_perturb_auf_outputs.append(single_perturb_auf_output)
+        arraylengths[j] = len(single_perturb_auf_output['Narray'])
+
+    return i, local_n, arraylengths, single_perturb_auf_outputs
+
+
 def download_trilegal_simulation(tri_folder, tri_filter_set, ax1, ax2, mag_num, region_frame,
                                  mag_lim, min_area, total_objs=1.5e6, av=None, sigma_av=0.1,
                                  rank=None, chunk_id=None):
@@ -461,10 +678,9 @@ def download_trilegal_simulation(tri_folder, tri_filter_set, ax1, ax2, mag_num,
             print(f'{t} Rank {rank}, chunk {chunk_id}: TRILEGAL call time: {end-start:.2f}')
             signal.alarm(0)
         with open(f'{tri_folder}/{tri_name}.dat', "r", encoding='utf-8') as f:
-            contents = f.readlines()
-        # Two comment lines; one at the top and one at the bottom - we add a
-        # third in a moment, however
-        nobjs = len(contents) - 2
+            # Two comment lines; one at the top and one at the bottom - we add
+            # a third in a moment, however
+            nobjs = sum(1 for _ in f) - 2
         # If too few stars then increase by factor 10 and loop, or scale to give
         # about total_objs stars and come out of area increase loop --
         # simulations can't be more than 10 sq deg, so accept if that's as large
@@ -494,7 +710,7 @@ def download_trilegal_simulation(tri_folder, tri_filter_set, ax1, ax2, mag_num,
             areaflag = 1
             accept_results = True
         if not accept_results:
-            os.system(f'rm {tri_folder}/{tri_name}.dat')
+            os.remove(f'{tri_folder}/{tri_name}.dat')
     if not accept_results:
         result = "timeout"
         while result == "timeout":
@@ -502,12 +718,13 @@ def download_trilegal_simulation(tri_folder, tri_filter_set, ax1, ax2, mag_num,
                 tri_name, ax1, ax2, folder=tri_folder, galactic=galactic_flag,
                 filterset=tri_filter_set, area=triarea, maglim=mag_lim, magnum=mag_num, av=av,
                 sigma_av=sigma_av)
-    with open(f'{tri_folder}/{tri_name}.dat', "r", encoding='utf-8') as f:
-        contents = f.readlines()
-    contents.insert(0, f'#area = {triarea} sq deg\n#Av at infinity = {av_inf}\n')
-    with open(f'{tri_folder}/{tri_name}.dat', "w", encoding='utf-8') as f:
-        contents = "".join(contents)
-        f.write(contents)
+    # Stream the simulation into a new file after the area and extinction
+    # header lines, rather than holding the entire simulation in memory.
+    with open(f'{tri_folder}/{tri_name}.dat', "r", encoding='utf-8') as f_in, \
+            open(f'{tri_folder}/{tri_name}.dat.tmp', "w", encoding='utf-8') as f_out:
+        f_out.write(f'#area = {triarea} sq deg\n#Av at infinity = {av_inf}\n')
+        shutil.copyfileobj(f_in, f_out, 2**20)
+    os.replace(f'{tri_folder}/{tri_name}.dat.tmp', f'{tri_folder}/{tri_name}.dat')
 
 
 def calculate_local_density(a_astro, a_tot_astro, a_tot_photo, density_radius, density_mag):
@@ -539,67 +756,72 @@ def calculate_local_density(a_astro, a_tot_astro, a_tot_photo, density_radius, d
         The number of sources per square degree near to each source in
         ``a_astro`` that are above ``density_mag`` in ``a_tot_astro``.
     '''
+    # Split the coordinates into contiguous longitude and latitude arrays once,
+    # rather than have every call copy the strided columns itself.
+    a_ax1, a_ax2 = np.ascontiguousarray(a_astro[:, :2].T)
+
+    min_lon, max_lon = min_max_lon(a_ax1)
+    min_lat, max_lat = np.amin(a_ax2), np.amax(a_ax2)
+
+    # Only keep the bright, nearby sources themselves, not the masks that
+    # select them, which would otherwise stay alive for the rest of the call.
+    a_astro_overlap_cut = a_tot_astro[
+        _load_rectangular_slice(a_tot_astro, min_lon, max_lon, min_lat, max_lat, density_radius) &
+        (a_tot_photo <= density_mag)]
+
+    if len(a_astro_overlap_cut) > 0:
+        # Count the bright sources within density_radius of each source with
+        # a KDTree of their Cartesian coordinates on the unit sphere, where
+        # the great-circle radius becomes a chord length.
+        kdt = spatial.KDTree(_unit_sphere_coords(a_astro_overlap_cut[:, 0], a_astro_overlap_cut[:, 1]),
+                             compact_nodes=False, balanced_tree=False)
+        full_counts = kdt.query_ball_point(_unit_sphere_coords(a_ax1, a_ax2),
+                                           2 * np.sin(np.radians(density_radius) / 2), return_length=True)
+        # If objects return with zero bright sources in their error circle,
+        # we force at least themselves to be in the circle, slightly
+        # over-representing any object below the brightness cutoff, but 1/area
+        # is still a very low density.
+        full_counts[full_counts == 0] = 1
+    else:
+        # If we have sources to check the surrounding density of, but
+        # no bright sources around them, just set them to be alone
+        # in the error circle, slightly over-representing bright objects
+        # but still giving them a very low normalising sky density.
+        full_counts = np.ones(len(a_astro), int)
 
-    min_lon, max_lon = min_max_lon(a_astro[:, 0])
-    min_lat, max_lat = np.amin(a_astro[:, 1]), np.amax(a_astro[:, 1])
-
-    overlap_sky_cut = _load_rectangular_slice(a_tot_astro, min_lon, max_lon, min_lat, max_lat, density_radius)
-    cut = overlap_sky_cut & (a_tot_photo <= density_mag)
-    a_astro_overlap_cut = a_tot_astro[cut]
-    a_photo_overlap_cut = a_tot_photo[cut]
-
-    ax1_loops = np.linspace(min_lon, max_lon, 11)
-    # Force the sub-division of the sky area in question to be 100 chunks, or
-    # roughly square degree chunks, whichever is larger in area.
-    if ax1_loops[1] - ax1_loops[0] < 1:
-        ax1_loops = np.linspace(min_lon, max_lon,
-                                int(np.ceil(max_lon - min_lon) + 1))
-    ax2_loops = np.linspace(min_lat, max_lat, 11)
-    if ax2_loops[1] - ax2_loops[0] < 1:
-        ax2_loops = np.linspace(min_lat, max_lat,
-                                int(np.ceil(max_lat - min_lat) + 1))
-    full_counts = np.empty(len(a_astro), float)
-    for ax1_start, ax1_end in zip(ax1_loops[:-1], ax1_loops[1:]):
-        for ax2_start, ax2_end in zip(ax2_loops[:-1], ax2_loops[1:]):
-            small_sky_cut = _load_rectangular_slice(a_astro, ax1_start, ax1_end, ax2_start, ax2_end, 0)
-            a_astro_small = a_astro[small_sky_cut]
-            if len(a_astro_small) == 0:
-                continue
-
-            overlap_sky_cut = _load_rectangular_slice(a_astro_overlap_cut, ax1_start, ax1_end, ax2_start,
-                                                      ax2_end, density_radius)
-            cut = overlap_sky_cut & (a_photo_overlap_cut <= density_mag)
-            a_astro_overlap_cut_small = a_astro_overlap_cut[cut]
-
-            if len(a_astro_overlap_cut_small) > 0:
-                counts = paf.get_density(a_astro_small[:, 0], a_astro_small[:, 1],
-                                         a_astro_overlap_cut_small[:, 0],
-                                         a_astro_overlap_cut_small[:, 1], density_radius)
-                # If objects return with zero bright sources in their error circle,
-                # like in the else below we force at least themselves to be in the
-                # circle, slightly over-representing any object below the
-                # brightness cutoff, but 1/area is still a very low density.
-                counts[counts == 0] = 1
-                full_counts[small_sky_cut] = counts
-            else:
-                # If we have sources to check the surrounding density of, but
-                # no bright sources around them, just set them to be alone
-                # in the error circle, slightly over-representing bright objects
-                # but still giving them a very low normalising sky density.
-                full_counts[small_sky_cut] = 1
     min_lon, max_lon = min_max_lon(a_astro_overlap_cut[:, 0])
     min_lat, max_lat = np.amin(a_astro_overlap_cut[:, 1]), np.amax(a_astro_overlap_cut[:, 1])
 
-    circle_overlap_area = paf.get_circle_area_overlap(a_astro[:, 0], a_astro[:, 1], density_radius,
+    circle_overlap_area = paf.get_circle_area_overlap(a_ax1, a_ax2, density_radius,
                                                       min_lon, max_lon, min_lat, max_lat)
 
     count_density = full_counts / circle_overlap_area
 
-    del cut
-
     return count_density
 
 
+def _unit_sphere_coords(lon, lat):
+    """
+    Converts sky coordinates to Cartesian coordinates on the unit sphere.
+
+    Parameters
+    ----------
+    lon : numpy.ndarray
+        The longitudes of the coordinates, in degrees.
+    lat : numpy.ndarray
+        The latitudes of the coordinates, in degrees.
+
+    Returns
+    -------
+    xyz : numpy.ndarray
+        The ``(N, 3)`` shape unit vectors of each coordinate.
+    """
+    lon, lat = np.radians(lon), np.radians(lat)
+    cos_lat = np.cos(lat)
+
+    return np.stack([cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)], axis=1)
+
+
 # pylint: disable=too-many-locals,too-many-arguments,too-many-statements
 def create_single_perturb_auf(auf_point, r, dr, j0s, num_trials, psf_fwhm, density_mag, a_photo, localn,
                               d_mag, mag_cut, dd_params, l_cut, run_fw, run_psf, snr_mag_params, al_av,
@@ -751,27 +973,20 @@ def create_single_perturb_auf(auf_point, r, dr, j0s, num_trials, psf_fwhm, densi
     # TODO: extend to allow a Galactic source model that doesn't depend on TRILEGAL  pylint: disable=fixme
     if tri_folder is not None:
         tri_name = 'trilegal_auf_simulation'
-    avs = np.empty((len(ax1s), len(ax2s)), float)
-    for j, ax1 in enumerate(ax1s):
-        for k, ax2 in enumerate(ax2s):
-            if region_frame == 'equatorial':
-                c = SkyCoord(ra=ax1, dec=ax2, unit='deg', frame='icrs')
-                l, b = c.galactic.l.degree, c.galactic.b.degree
-            else:
-                l, b = ax1, ax2
-            av = get_av_infinity(l, b, frame='galactic')[0]
-            avs[j, k] = av
-    avs = avs.flatten()
+    avs = _get_av_grid(tuple(ax1s), tuple(ax2s), region_frame)
     if tri_folder is not None:
         (dens_hist_tri, model_mags, model_mag_mids, model_mags_interval, _,
          n_bright_sources_star) = make_tri_counts(
             tri_folder, tri_name, filt_header, d_mag, np.amin(a_photo), density_mag, al_av=al_av,
             av_grid=avs)
 
-    log10y_tri = -np.inf * np.ones_like(dens_hist_tri)
-    log10y_tri[dens_hist_tri > 0] = np.log10(dens_hist_tri[dens_hist_tri > 0])
+    populated_tri_bins = dens_hist_tri > 0
+    log10y_tri = np.log10(dens_hist_tri, out=np.full_like(dens_hist_tri, -np.inf, dtype=float),
+                          where=populated_tri_bins)
 
-    mag_slice = model_mags+model_mags_interval <= density_mag
+    # Model magnitude bins are ascending, so those entirely brighter than
+    # density_mag form a contiguous run at the start of the arrays.
+    mag_slice = slice(0, np.searchsorted(model_mags+model_mags_interval, density_mag, side='right'))
     tri_count = np.sum(10**log10y_tri[mag_slice] * model_mags_interval[mag_slice])
 
     if fit_gal_flag:
@@ -780,15 +995,14 @@ def create_single_perturb_auf(auf_point, r, dr, j0s, num_trials, psf_fwhm, densi
         gal_dens = create_galaxy_counts(cmau_array, model_mag_mids, z_array, wav, alpha0, alpha1,
                                         alpha_weight, ab_offset, filter_name, al_grid)
         gal_count = np.sum(gal_dens[mag_slice] * model_mags_interval[mag_slice])
-        log10y_gal = -np.inf * np.ones_like(log10y_tri)
-        log10y_gal[gal_dens > 0] = np.log10(gal_dens[gal_dens > 0])
+        log10y_gal = np.log10(gal_dens, out=np.full_like(log10y_tri, -np.inf), where=gal_dens > 0)
     else:
         gal_count = 0
-        log10y_gal = -np.inf * np.ones_like(log10y_tri)
+        log10y_gal = np.full_like(log10y_tri, -np.inf)
 
         # If we're not generating galaxy counts, we have to solely rely on
         # TRILEGAL counting statistics, so we only want to keep populated bins.
-        hc = np.where(dens_hist_tri > 0)[0]
+        hc = np.flatnonzero(populated_tri_bins)
         model_mag_mids = model_mag_mids[hc]
         model_mags_interval = model_mags_interval[hc]
         log10y_tri = log10y_tri[hc]
@@ -841,7 +1055,8 @@ def create_single_perturb_auf(auf_point, r, dr, j0s, num_trials, psf_fwhm, densi
                          "reliably derive a model source density. Please include "
                          "more simulated objects.")
 
-    log10y = np.log10(10**log10y_tri * tri_corr + 10**log10y_gal * gal_corr)
+    y = 10**log10y_tri * tri_corr + 10**log10y_gal * gal_corr
+    log10y = np.log10(y, out=np.full_like(y, -np.inf), where=y > 0)
 
     # Set a magnitude bin width of 0.25 mags, to avoid oversampling.
     dmag = 0.25
@@ -857,8 +1072,14 @@ def create_single_perturb_auf(auf_point, r, dr, j0s, num_trials, psf_fwhm, densi
     logn_max = dlogn * np.ceil(np.amax(lognvals)/dlogn)
     lognbins = np.arange(logn_min, logn_max+1e-10, dlogn)
 
-    counts, lognbins, magbins = np.histogram2d(lognvals, a_photo, bins=[lognbins, magbins])
-    ni, magi = np.where(counts > 0)
+    # Find the occupied density-magnitude cells by counting sources in the
+    # flattened 2-D grid, locating each source's bins directly from their
+    # regular spacing rather than searching the bin edges.
+    ni, n_keep = _regular_bin_indices(lognvals, lognbins)
+    mi, m_keep = _regular_bin_indices(a_photo, magbins)
+    n_magbins = len(magbins) - 1
+    counts = np.bincount((ni * n_magbins + mi)[n_keep & m_keep], minlength=(len(lognbins) - 1) * n_magbins)
+    ni, magi = np.divmod(np.flatnonzero(counts), n_magbins)
     mag_array = 0.5*(magbins[1:]+magbins[:-1])[magi]
     count_array = np.exp(0.5*(lognbins[1:]+lognbins[:-1])[ni])
 
@@ -876,8 +1097,8 @@ def create_single_perturb_auf(auf_point, r, dr, j0s, num_trials, psf_fwhm, densi
     dm_max = _calculate_magnitude_offsets(count_array, mag_array, b, snr, model_mag_mids, log10y,
                                           model_mags_interval, psf_r, model_count)
 
-    seed = np.random.default_rng().choice(100000, size=(paf.get_random_seed_size(),
-                                                        len(count_array)))
+    seed = np.random.default_rng().integers(100000, size=(paf.get_random_seed_size(),
+                                                          len(count_array)))
 
     psf_sig = psf_fwhm / (2 * np.sqrt(2 * np.log(2)))
 
@@ -898,10 +1119,17 @@ def create_single_perturb_auf(auf_point, r, dr, j0s, num_trials, psf_fwhm, densi
         h = 1 - np.sqrt(1 - np.minimum(np.ones_like(snr), a_snr**2 * snr**2))
         flux = h * flux_fw + (1 - h) * flux_psf
         h = h.reshape(1, -1)
-        frac = h * frac_fw + (1 - h) * frac_psf
-        offset = h * offset_fw + (1 - h) * offset_psf
-        cumulative = h * cumulative_fw + (1 - h) * cumulative_psf
-        fourieroffset = h * fourieroffset_fw + (1 - h) * fourieroffset_psf
+        one_minus_h = 1 - h
+        # Weight the two algorithms' outputs in place, with the sum overwriting
+        # the flux-weighted arrays, to avoid allocating temporary arrays the
+        # size of each output.
+        for output_fw, output_psf in [(frac_fw, frac_psf), (offset_fw, offset_psf),
+                                      (cumulative_fw, cumulative_psf),
+                                      (fourieroffset_fw, fourieroffset_psf)]:
+            output_fw *= h
+            output_psf *= one_minus_h
+            output_fw += output_psf
+        frac, offset, cumulative, fourieroffset = frac_fw, offset_fw, cumulative_fw, fourieroffset_fw
     elif run_fw:
         flux = flux_fw
         frac = frac_fw
@@ -924,6 +1152,38 @@ def create_single_perturb_auf(auf_point, r, dr, j0s, num_trials, psf_fwhm, densi
     return single_perturb_auf_output
 
 
+@functools.lru_cache(maxsize=256)
+def _get_av_grid(ax1s, ax2s, region_frame):
+    """
+    Determines the extinction at infinity for a grid of sky positions. As the
+    same grid is used for every filter of a given sky position, lookups are
+    cached.
+
+    Parameters
+    ----------
+    ax1s : tuple of floats
+        The longitudes of the grid of sky positions.
+    ax2s : tuple of floats
+        The latitudes of the grid of sky positions.
+    region_frame : string
+        The coordinate frame of ``ax1s`` and ``ax2s``, either ``equatorial``
+        or ``galactic``.
+
+    Returns
+    -------
+    avs : numpy.ndarray
+        The read-only V-band extinctions at infinity of each combination of
+        ``ax1s`` and ``ax2s``, ordered with ``ax2s`` varying fastest.
+    """
+    # Look up the extinctions of the full grid of sky positions in one call.
+    ax1_grid, ax2_grid = np.meshgrid(ax1s, ax2s, indexing='ij')
+    avs = get_av_infinity(ax1_grid.ravel(), ax2_grid.ravel(),
+                          frame='icrs' if region_frame == 'equatorial' else 'galactic')
+    avs.flags.writeable = False
+
+    return avs
+
+
 # pylint: disable=too-many-locals,too-many-statements
 def make_tri_counts(trifolder, trifilename, trifiltname, dm, brightest_source_mag,
                     density_mag, use_bright=False, use_faint=True, al_av=None, av_grid=None):
@@ -1003,9 +1263,8 @@ def make_tri_counts(trifolder, trifilename, trifiltname, dm, brightest_source_ma
         tri_av_inf_faint = float(bits[4])
         if tri_av_inf_faint < 0.1 and av_grid is not None:
             raise ValueError("tri_av_inf_faint cannot be smaller than 0.1 while using av_grid.")
-        tri_faint = np.genfromtxt(f'{trifolder}/{trifilename}_faint.dat', delimiter=None,
-                                  names=True, comments='#', skip_header=2,
-                                  usecols=[trifiltname, 'Av'])
+        tridata_faint, avs_faint = _load_trilegal_columns(f'{trifolder}/{trifilename}_faint.dat',
+                                                          trifiltname)
 
     if use_bright:
         with open(f'{trifolder}/{trifilename}_bright.dat', "r", encoding='utf-8') as f:
@@ -1017,22 +1276,13 @@ def make_tri_counts(trifolder, trifilename, trifiltname, dm, brightest_source_ma
         tri_av_inf_bright = float(bits[4])
         if tri_av_inf_bright < 0.1 and av_grid is not None:
             raise ValueError("tri_av_inf_bright cannot be smaller than 0.1 while using av_grid.")
-        tri_bright = np.genfromtxt(f'{trifolder}/{trifilename}_bright.dat',
-                                   delimiter=None, names=True, comments='#', skip_header=2,
-                                   usecols=[trifiltname, 'Av'])
+        tridata_bright, avs_bright = _load_trilegal_columns(f'{trifolder}/{trifilename}_bright.dat',
+                                                            trifiltname)
 
     if use_faint:
-        tridata_faint = tri_faint[:][trifiltname]
-        tri_av_faint = np.amax(tri_faint[:]['Av'])
-        if al_av is not None:
-            avs_faint = tri_faint[:]['Av']
-        del tri_faint
+        tri_av_faint = np.amax(avs_faint)
     if use_bright:
-        tridata_bright = tri_bright[:][trifiltname]
-        tri_av_bright = np.amax(tri_bright[:]['Av'])
-        if al_av is not None:
-            avs_bright = tri_bright[:]['Av']
-        del tri_bright
+        tri_av_bright = np.amax(avs_bright)
 
     minmag = dm * np.floor(brightest_source_mag/dm)
     if use_bright and use_faint:
@@ -1052,35 +1302,36 @@ def make_tri_counts(trifolder, trifilename, trifiltname, dm, brightest_source_ma
             tri_mags = np.arange(minmag-al_av*tri_av_bright, maxmag+1e-10, dm)
         elif use_faint:
             tri_mags = np.arange(minmag-al_av*tri_av_faint, maxmag+1e-10, dm)
-    tri_mags_mids = tri_mags[:-1]+np.diff(tri_mags)/2
+    dtri_mags = np.diff(tri_mags)
+    tri_mags_mids = tri_mags[:-1]+dtri_mags/2
     if use_faint:
         if al_av is None:
-            hist, tri_mags = np.histogram(tridata_faint, bins=tri_mags)
+            hist = paf.regular_histogram(tridata_faint, tri_mags)
         else:
-            hist = np.zeros((len(tri_mags) - 1), int)
-            for av in av_grid:
-                # Take the ratio of AVs for scaling (i.e., if we'd run TRILEGAL
-                # with AV=1 but av_grid[0] = 2, we get 2x the extinction at each
-                # distance we'd otherwise have found. Or, if AV=1,
-                # av_grid[1]=0.25, then we have a quarter the infinite-distance
-                # extinction and hence 25% the extinction applied to the source.
-                av_ratio = av / tri_av_inf_faint
-                # Apply the correction. Here if av_grid[i] = AV then we do
-                # nothing; otherwise av_ratio = 2 gives an extra 100% AV,
-                # and e.g. av_ratio = 0.25 subtracts three-quarters of the
-                # applied AV value. These are scaled to the correct extinction
-                # vector subsequently.
-                m = tridata_faint + (av_ratio - 1) * avs_faint * al_av
-                y, _ = np.histogram(m, bins=tri_mags)
-                hist += y
+            # Take the ratio of AVs for scaling (i.e., if we'd run TRILEGAL
+            # with AV=1 but av_grid[0] = 2, we get 2x the extinction at each
+            # distance we'd otherwise have found. Or, if AV=1,
+            # av_grid[1]=0.25, then we have a quarter the infinite-distance
+            # extinction and hence 25% the extinction applied to the source.
+            # The correction is applied to each magnitude as
+            # m + (av_ratio - 1) * av * al_av: if av_grid[i] = AV then we do
+            # nothing; otherwise av_ratio = 2 gives an extra 100% AV,
+            # and e.g. av_ratio = 0.25 subtracts three-quarters of the
+            # applied AV value, scaled to the correct extinction vector. All
+            # extinctions are histogrammed in one pass through the simulation.
+            hist = paf.av_grid_histogram(tridata_faint, avs_faint, np.asarray(av_grid) / tri_av_inf_faint,
+                                         al_av, tri_mags)
         hc_faint = hist > 3
-        dens_faint = hist / np.diff(tri_mags) / tri_area_faint
-        dens_uncert_faint = np.sqrt(hist) / np.diff(tri_mags) / tri_area_faint
+        dens_faint = hist / dtri_mags
+        dens_faint /= tri_area_faint
+        dens_uncert_faint = np.sqrt(hist)
+        dens_uncert_faint /= dtri_mags
+        dens_uncert_faint /= tri_area_faint
         # Account for summing NxM Avs here by dividing out len(av_grid).
         if av_grid is not None:
-            dens_faint = dens_faint / len(av_grid)
-            dens_uncert_faint = dens_uncert_faint / np.sqrt(len(av_grid))
-        dens_uncert_faint[dens_uncert_faint == 0] = 1e10
+            dens_faint /= len(av_grid)
+            dens_uncert_faint /= np.sqrt(len(av_grid))
+        dens_uncert_faint[hist == 0] = 1e10
         # Now check whether there are sufficient sources at the bright end of
         # the simulation, counting the sources brighter than density_mag.
         num_bright_obj_faint = np.sum(hist[tri_mags[:-1] < density_mag])
@@ -1088,21 +1339,20 @@ def make_tri_counts(trifolder, trifilename, trifiltname, dm, brightest_source_ma
             num_bright_obj_faint /= len(av_grid)
     if use_bright:
         if al_av is None:
-            hist, tri_mags = np.histogram(tridata_bright, bins=tri_mags)
+            hist = paf.regular_histogram(tridata_bright, tri_mags)
         else:
-            hist = np.zeros((len(tri_mags) - 1), int)
-            for av in av_grid:
-                av_ratio = av / tri_av_inf_bright
-                m = tridata_bright + (av_ratio - 1) * avs_bright * al_av
-                y, _ = np.histogram(m, bins=tri_mags)
-                hist += y
+            hist = paf.av_grid_histogram(tridata_bright, avs_bright,
+                                         np.asarray(av_grid) / tri_av_inf_bright, al_av, tri_mags)
         hc_bright = hist > 3
-        dens_bright = hist / np.diff(tri_mags) / tri_area_bright
-        dens_uncert_bright = np.sqrt(hist) / np.diff(tri_mags) / tri_area_bright
+        dens_bright = hist / dtri_mags
+        dens_bright /= tri_area_bright
+        dens_uncert_bright = np.sqrt(hist)
+        dens_uncert_bright /= dtri_mags
+        dens_uncert_bright /= tri_area_bright
         if av_grid is not None:
-            dens_bright = dens_bright / len(av_grid)
-            dens_uncert_bright = dens_uncert_bright / np.sqrt(len(av_grid))
-        dens_uncert_bright[dens_uncert_bright == 0] = 1e10
+            dens_bright /= len(av_grid)
+            dens_uncert_bright /= np.sqrt(len(av_grid))
+        dens_uncert_bright[hist == 0] = 1e10
         num_bright_obj_bright = np.sum(hist[tri_mags[:-1] < density_mag])
         if av_grid is not None:
             num_bright_obj_bright /= len(av_grid)
@@ -1113,11 +1363,22 @@ def make_tri_counts(trifolder, trifilename, trifiltname, dm, brightest_source_ma
         # likely to be objects in magnitudes that don't define the TRILEGAL cutoff,
         # where differential reddening can make a few of them slightly fainter than
         # average.
-        bright_cutoff_mag = tri_mags[1:][np.argmax(hist)]
-        dens_uncert_bright[tri_mags[1:] > bright_cutoff_mag] = 1e10
-        w_f, w_b = 1 / dens_uncert_faint**2, 1 / dens_uncert_bright**2
-        dens = (dens_bright * w_b + dens_faint * w_f) / (w_b + w_f)
-        dens_uncert = (dens_uncert_bright * w_b + dens_uncert_faint * w_f) / (w_b + w_f)
+        # tri_mags is strictly increasing, so every bin fainter than the peak
+        # of the bright simulation's histogram lies after its index.
+        dens_uncert_bright[np.argmax(hist)+1:] = 1e10
+        # Inverse-variance weight the two simulations, re-using the per-simulation
+        # arrays to hold the weighted terms rather than allocating new ones.
+        w_f, w_b = dens_uncert_faint**2, dens_uncert_bright**2
+        np.reciprocal(w_f, out=w_f)
+        np.reciprocal(w_b, out=w_b)
+        w_tot = w_b + w_f
+        dens = np.add(np.multiply(dens_bright, w_b, out=dens_bright),
+                      np.multiply(dens_faint, w_f, out=dens_faint), out=dens_bright)
+        dens /= w_tot
+        dens_uncert = np.add(np.multiply(dens_uncert_bright, w_b, out=dens_uncert_bright),
+                             np.multiply(dens_uncert_faint, w_f, out=dens_uncert_faint),
+                             out=dens_uncert_bright)
+        dens_uncert /= w_tot
         hc = hc_bright | hc_faint
 
         num_bright_obj = max(num_bright_obj_faint, num_bright_obj_bright)
@@ -1134,15 +1395,118 @@ def make_tri_counts(trifolder, trifilename, trifiltname, dm, brightest_source_ma
 
         num_bright_obj = num_bright_obj_faint
 
+    # Resolve the populated bins once, and gather each output with the indices.
+    hc = np.flatnonzero(hc)
     dens = dens[hc]
-    dtri_mags = np.diff(tri_mags)[hc]
+    dtri_mags = dtri_mags[hc]
     tri_mags_mids = tri_mags_mids[hc]
-    tri_mags = tri_mags[:-1][hc]
+    tri_mags = tri_mags[hc]
     uncert = dens_uncert[hc]
 
     return dens, tri_mags, tri_mags_mids, dtri_mags, uncert, num_bright_obj
 
 
+def _load_trilegal_columns(tri_file, trifiltname):
+    """
+    Loads the magnitudes in a single filter, and the V-band extinctions, of
+    the objects in a TRILEGAL simulation.
+
+    Parameters
+    ----------
+    tri_file : string
+        The location of the TRILEGAL simulation, including the two lines of
+        area and extinction header added by ``download_trilegal_simulation``.
+    trifiltname : string
+        The name of the column in ``tri_file`` holding the magnitudes to load.
+
+    Returns
+    -------
+    mags : numpy.ndarray
+        The magnitudes of each simulated object in ``trifiltname``.
+    avs : numpy.ndarray
+        The V-band extinction of each simulated object.
+
+    Notes
+    -----
+    The loaded columns are saved alongside ``tri_file``, in a ``.npz`` file
+    named for both the simulation and ``trifiltname``, and re-used in place of
+    parsing ``tri_file`` again for as long as the simulation is not updated.
+    A cache that cannot be read is ignored, and rewritten from ``tri_file``.
+    """
+    cache_file = f'{os.path.splitext(tri_file)[0]}_{trifiltname}.npz'
+    if os.path.isfile(cache_file) and os.path.getmtime(cache_file) > os.path.getmtime(tri_file):
+        try:
+            with np.load(cache_file) as cache:
+                return cache['mags'], cache['avs']
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            # An unreadable cache is simply replaced by parsing the simulation.
+            pass
+
+    with open(tri_file, "r", encoding='utf-8') as f:
+        f.readline()
+        f.readline()
+        column_line = f.readline()
+    # The column names follow the area and extinction lines, optionally
+    # commented out. Column names can also be given with the characters
+    # np.genfromtxt removes from field names stripped, as they were previously
+    # loaded with names=True.
+    names = column_line.lstrip('#').split()
+    deletechars = set(r"""~!@#$%^&*()-=+~\|]}[{';: /?.>,<""")
+    stripped_names = [''.join(c for c in name if c not in deletechars) for name in names]
+    mag_ind, av_ind = [names.index(name) if name in names else stripped_names.index(name)
+                       for name in [trifiltname, 'Av']]
+    tri = pd.read_csv(tri_file, sep=r'\s+', comment='#', skiprows=3, header=None,
+                      usecols=[mag_ind, av_ind], engine='c')
+
+    mags, avs = tri[mag_ind].to_numpy(dtype=float), tri[av_ind].to_numpy(dtype=float)
+    # Write the cache under a temporary name first, so that an interrupted
+    # write never leaves a partial cache in place.
+    tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, mags=mags, avs=avs)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        # Without write access to the simulation folder we simply parse the
+        # simulation again next time.
+        if os.path.isfile(tmp_file):
+            os.remove(tmp_file)
+
+    return mags, avs
+
+
+def _regular_bin_indices(values, bins):
+    """
+    Determines the bin each value falls into, for regularly spaced bins,
+    following the conventions of ``np.histogram``.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        The values to place into bins.
+    bins : numpy.ndarray
+        The ascending, regularly spaced, bin edges.
+
+    Returns
+    -------
+    inds : numpy.ndarray
+        The index of the bin each value falls into, with bins closed on the
+        left except for the final bin, which also includes its right-hand edge.
+    in_range : numpy.ndarray
+        Boolean array indicating whether each value lies within the bins at
+        all; ``inds`` is meaningless for values outside of ``bins``.
+    """
+    n_bins = len(bins) - 1
+    inds = np.clip(((values - bins[0]) * (n_bins / (bins[-1] - bins[0]))).astype(int), 0, n_bins - 1)
+    # Correct for any rounding in the bin edges, which are not necessarily
+    # exact multiples of their spacing.
+    inds -= values < bins[inds]
+    inds += (values >= bins[inds + 1]) & (inds < n_bins - 1)
+    in_range = (values >= bins[0]) & (values <= bins[-1])
+
+    return inds, in_range
+
+
 def _calculate_magnitude_offsets(count_array, mag_array, b, snr, model_mag_mids, log10y,
                                  model_mags_interval, r, n_norm):
     '''
@@ -1183,31 +1547,30 @@ def _calculate_magnitude_offsets(count_array, mag_array, b, snr, model_mag_mids,
     flim = b / snr
     dm_max_snr = -2.5 * np.log10(flim)
 
-    dm_max_no_perturb = np.empty_like(mag_array)
-    for i, mag in enumerate(mag_array):
-        q = model_mag_mids >= mag
-        if np.sum(q) == 0:
-            dm_max_no_perturb[i] = 0
-            continue
-        _x = model_mag_mids[q]
-        _y = 10**log10y[q] * model_mags_interval[q] * np.pi * (r/3600)**2 * count_array[i] / n_norm
-
-        # Convolution of Poissonian distributions each with l_i is a Poissonian
-        # with mean of sum_i l_i.
-        lamb = np.cumsum(_y)
-        # CDF of Poissonian is regularised gamma Q(floor(k + 1), lambda), and we
-        # want k = 0; we wish to find the dm that gives sufficiently large lambda
-        # that k = 0 only occurs <= x% of the time. If lambda is too small then
-        # k = 0 is too likely. P(X <= 0; lambda) = exp(-lambda).
-        # For 1% chance of no perturber we want 0.01 = exp(-lambda); rearranging
-        # lambda = -ln(0.01).
-        q = np.where(lamb >= -np.log(0.01))[0]
-        if len(q) > 0:
-            dm_max_no_perturb[i] = _x[q[0]] - mag
-        else:
-            # In the case that we can't go deep enough in our simulated counts to
-            # get <1% chance of no perturber, just do the best we can.
-            dm_max_no_perturb[i] = _x[-1] - mag
+    # Every source shares the same simulated counts, differing only in the
+    # faintest magnitude it starts from and the scaling by its local density.
+    base = 10**log10y * model_mags_interval * np.pi * (r/3600)**2 / n_norm
+    # Convolution of Poissonian distributions each with l_i is a Poissonian
+    # with mean of sum_i l_i, so the expected number of perturbers of each
+    # source down to each model magnitude is the difference between this
+    # cumulative sum at that magnitude and at the source's own magnitude.
+    lamb = np.append(0, np.cumsum(base))
+    # Bins with model_mag_mids >= mag are all those from start onwards.
+    start = np.searchsorted(model_mag_mids, mag_array, side='left')
+    # CDF of Poissonian is regularised gamma Q(floor(k + 1), lambda), and we
+    # want k = 0; we wish to find the dm that gives sufficiently large lambda
+    # that k = 0 only occurs <= x% of the time. If lambda is too small then
+    # k = 0 is too likely. P(X <= 0; lambda) = exp(-lambda).
+    # For 1% chance of no perturber we want 0.01 = exp(-lambda); rearranging
+    # lambda = -ln(0.01).
+    with np.errstate(divide='ignore'):
+        lamb_target = lamb[start] + -np.log(0.01) / count_array
+    end = np.searchsorted(lamb, lamb_target, side='left')
+    # In the case that we can't go deep enough in our simulated counts to
+    # get <1% chance of no perturber, just do the best we can.
+    end = np.minimum(end, len(model_mag_mids))
+    dm_max_no_perturb = np.where(start < len(model_mag_mids),
+                                 model_mag_mids[np.maximum(end, 1) - 1] - mag_array, 0)
 
     dm = np.maximum(dm_max_snr, dm_max_no_perturb)
 
@@ -11,42 +11,130 @@ real(dp), parameter :: pi = 4.0_dp*atan(1.0_dp)
 
 contains
 
-subroutine get_density(a_ax1, a_ax2, b_ax1, b_ax2, maxdist, counts)
-    ! Calculate the number of sources in a given catalogue within a specified radius of each source.
+subroutine find_closest_nm_points(source_n, source_mag, axinds, filterinds, narrays, magarrays, arraylengths, &
+    nm_inds)
+    ! For each source, find the closest density-magnitude combination in the set of simulated
+    ! perturbation AUFs for its sky position and filter.
     integer, parameter :: dp = kind(0.0d0)  ! double precision
-    ! Sky coordinates for catalogues a and b.
-    real(dp), intent(in) :: a_ax1(:), a_ax2(:), b_ax1(:), b_ax2(:)
-    ! Separation to consider the number of objects within.
-    real(dp), intent(in) :: maxdist
-    ! Number of objects within maxdist of each catalogue a source.
-    integer, intent(out) :: counts(size(a_ax1))
-    ! Loop counters.
-    integer :: i, j
-    ! Sky separations.
-    real(dp) :: dist, dx, d_ax1, d_ax2
-
-    counts = 0
-!$OMP PARALLEL DO DEFAULT(NONE) PRIVATE(i, j, dist, dx, d_ax1, d_ax2) SHARED(a_ax1, a_ax2, b_ax1, b_ax2, counts, maxdist)
-    do j = 1, size(a_ax1)
-        do i = 1, size(b_ax1)
-            ! Difference in latitude is always just the absolute difference
-            d_ax2 = abs(a_ax2(j) - b_ax2(i))
-            if (d_ax2 <= maxdist) then
-                ! Need reduction of Haversine formula for longitude difference, remembering to convert to degrees:
-                d_ax1 = 2.0_dp * asin(abs(cos(a_ax2(j) / 180.0_dp * pi) * &
-                                      sin((a_ax1(j) - b_ax1(i))/2.0_dp / 180.0_dp * pi))) * 180.0_dp / pi
-                if (d_ax1 <= maxdist) then
-                    call haversine(a_ax1(j), b_ax1(i), a_ax2(j), b_ax2(i), dist)
-                    if (dist <= maxdist) then
-                        counts(j) = counts(j) + 1
-                    end if
-                end if
+    ! Local normalising densities and magnitudes of each source, in its reference filter.
+    real(dp), intent(in) :: source_n(:), source_mag(:)
+    ! Zero-indexed sky position and filter indices of each source.
+    integer, intent(in) :: axinds(:), filterinds(:)
+    ! Density and magnitude arrays of each sky position-filter combination, shape (longestnm, nfilt, naxs).
+    real(dp), intent(in) :: narrays(:, :, :), magarrays(:, :, :)
+    ! Number of valid N-m combinations in each filter-sky position combination.
+    integer, intent(in) :: arraylengths(:, :)
+    ! Zero-indexed closest N-m combination for each source.
+    integer, intent(out) :: nm_inds(size(source_n))
+    ! Loop counters and array indices.
+    integer :: i, k, f, ax
+    ! Source density and magnitude, their offsets from a simulated combination, and squared distances in N-m space.
+    real(dp) :: n, mag, dn, dmag, dist, min_dist
+
+!$OMP PARALLEL DO DEFAULT(NONE) PRIVATE(i, k, f, ax, n, mag, dn, dmag, dist, min_dist) &
+!$OMP& SHARED(source_n, source_mag, axinds, filterinds, narrays, magarrays, arraylengths, nm_inds)
+    do i = 1, size(source_n)
+        f = filterinds(i) + 1
+        ax = axinds(i) + 1
+        ! Default to the first combination, in line with argmin of an all-NaN set of distances.
+        nm_inds(i) = 0
+        min_dist = huge(1.0_dp)
+        n = source_n(i)
+        mag = source_mag(i)
+        do k = 1, arraylengths(f, ax)
+            dn = n - narrays(k, f, ax)
+            dmag = mag - magarrays(k, f, ax)
+            dist = dn * dn + dmag * dmag
+            if (dist < min_dist) then
+                min_dist = dist
+                nm_inds(i) = k - 1  ! pre-convert one-index fortran to zero-index python indices
             end if
         end do
     end do
 !$OMP END PARALLEL DO
 
-end subroutine get_density
+end subroutine find_closest_nm_points
+
+subroutine av_grid_histogram(mags, avs, av_ratios, al_av, bins, hist)
+    ! Histogram simulated magnitudes, re-scaled to each of a set of extinctions, in a single pass through the
+    ! simulated objects. Bins follow numpy.histogram, being closed on the left except for the final bin,
+    ! which also includes its right-hand edge.
+    integer, parameter :: dp = kind(0.0d0)  ! double precision
+    ! Magnitudes and V-band extinctions of each simulated object.
+    real(dp), intent(in) :: mags(:), avs(:)
+    ! Ratios of each extinction to that the simulation was run with, and the extinction vector of the filter.
+    real(dp), intent(in) :: av_ratios(:), al_av
+    ! Magnitude bin edges, ascending and regularly spaced.
+    real(dp), intent(in) :: bins(:)
+    ! Number of objects in each bin, summed across all extinctions.
+    integer, intent(out) :: hist(size(bins)-1)
+    ! Loop counters and bin index.
+    integer :: i, k, n_bins, ibin
+    ! Re-scaled magnitude, and inverse bin width.
+    real(dp) :: m, inv_dm
+
+    n_bins = size(bins) - 1
+    inv_dm = n_bins / (bins(n_bins+1) - bins(1))
+    hist = 0
+!$OMP PARALLEL DO DEFAULT(NONE) PRIVATE(i, k, ibin, m) SHARED(mags, avs, av_ratios, al_av, bins, n_bins, inv_dm) &
+!$OMP& REDUCTION(+:hist)
+    do i = 1, size(mags)
+        do k = 1, size(av_ratios)
+            m = mags(i) + (av_ratios(k) - 1.0_dp) * avs(i) * al_av
+            ! Also rejects NaN magnitudes, for which all comparisons are false.
+            if (m >= bins(1) .and. m <= bins(n_bins+1)) then
+                ! Estimate the bin from the regular spacing, then correct for any rounding in the bin edges.
+                ibin = min(max(int((m - bins(1)) * inv_dm) + 1, 1), n_bins)
+                do while (ibin > 1 .and. m < bins(ibin))
+                    ibin = ibin - 1
+                end do
+                do while (ibin < n_bins .and. m >= bins(ibin+1))
+                    ibin = ibin + 1
+                end do
+                hist(ibin) = hist(ibin) + 1
+            end if
+        end do
+    end do
+!$OMP END PARALLEL DO
+
+end subroutine av_grid_histogram
+
+subroutine regular_histogram(values, bins, hist)
+    ! Histogram values into regularly spaced bins, following the conventions of numpy.histogram, with bins
+    ! closed on the left except for the final bin, which also includes its right-hand edge.
+    integer, parameter :: dp = kind(0.0d0)  ! double precision
+    ! Values to histogram.
+    real(dp), intent(in) :: values(:)
+    ! Bin edges, ascending and regularly spaced.
+    real(dp), intent(in) :: bins(:)
+    ! Number of values in each bin.
+    integer, intent(out) :: hist(size(bins)-1)
+    ! Loop counter, number of bins, and bin index.
+    integer :: i, n_bins, ibin
+    ! Inverse bin width.
+    real(dp) :: inv_dm
+
+    n_bins = size(bins) - 1
+    inv_dm = n_bins / (bins(n_bins+1) - bins(1))
+    hist = 0
+!$OMP PARALLEL DO DEFAULT(NONE) PRIVATE(i, ibin) SHARED(values, bins, n_bins, inv_dm) REDUCTION(+:hist)
+    do i = 1, size(values)
+        ! Also rejects NaN values, for which all comparisons are false.
+        if (values(i) >= bins(1) .and. values(i) <= bins(n_bins+1)) then
+            ! Estimate the bin from the regular spacing, then correct for any rounding in the bin edges.
+            ibin = min(max(int((values(i) - bins(1)) * inv_dm) + 1, 1), n_bins)
+            do while (ibin > 1 .and. values(i) < bins(ibin))
+                ibin = ibin - 1
+            end do
+            do while (ibin < n_bins .and. values(i) >= bins(ibin+1))
+                ibin = ibin + 1
+            end do
+            hist(ibin) = hist(ibin) + 1
+        end if
+    end do
+!$OMP END PARALLEL DO
+
+end subroutine regular_histogram
 
 subroutine get_circle_area_overlap(cat_ax1, cat_ax2, density_radius, min_lon, max_lon, min_lat, max_lat, circ_overlap_area)
     ! Calculates the amount of circle overlap with a rectangle of particular coordinates. Adapted from